@@ -10,38 +10,121 @@
 # The bot can also handle multiple characters and scenarios.
 # It is designed to be easy to use and customize.
 
+# imported first: the import time of the other modules is measured from here
+from startup_profiler import startup_profiler
+import argparse
 import asyncio
 import contextlib
+import signal
 from telegram.ext import ApplicationBuilder
 from telegram.request import HTTPXRequest
-from bot_state import bot_state, init_config, load_roles, save_roles, load_history, save_history
+from bot_state import bot_state, init_config, init_state_backend, load_roles, save_roles, load_history, save_history
 from telegram_handlers import register_handlers, get_bot_commands
-from config import (CONNECT_TIMEOUT, READ_TIMEOUT)
+from rate_limiter import OutboundRateLimiter
+from typing_ticker import typing_ticker
+from loop_monitor import loop_monitor
+from tokenizers_registry import warm_up_tokenizers
+from config_reload import validate_config, reload_config
+from config import (CONNECT_TIMEOUT, READ_TIMEOUT, DRAIN_TIMEOUT, TELEGRAM_GLOBAL_RATE)
+
+
+
+# Starting the webhook server
+# The embedded HTTP server accepts updates from Telegram (or from a load balancer).
+# If "cert"/"key" are empty, TLS is expected to be terminated by a reverse proxy.
+async def start_webhook(app, webhook_config: dict):
+    await app.updater.start_webhook(
+        listen=webhook_config.get("listen", "0.0.0.0"),
+        port=webhook_config.get("port", 8443),
+        url_path=webhook_config.get("url_path", ""),
+        webhook_url=webhook_config.get("webhook_url") or None,
+        secret_token=bot_state.credentials.get("webhook_secret_token") or None,
+        cert=webhook_config.get("cert") or None,
+        key=webhook_config.get("key") or None,
+        max_connections=webhook_config.get("max_connections", 40),
+        drop_pending_updates=webhook_config.get("drop_pending_updates", False),
+    )
 
 
 
-# Main function to run the bot
-# This function initializes the bot, loads roles and history, and starts the bot.
-async def main():
+# Time to finish in-flight updates on shutdown (older configs keep it in runtime.webhook)
+def get_drain_timeout(runtime: dict) -> float:
+    return runtime.get("drain_timeout", runtime.get("webhook", {}).get("drain_timeout", DRAIN_TIMEOUT))
 
-    init_config()
 
-    if not bot_state.bot_token:
-        raise ValueError("Не указан токен бота в config.json!")
 
-    load_roles()
-    load_history()
+# Draining: app.stop() waits for updates that are already being processed.
+# If they don't finish in time, stop() is cancelled, so it does not keep running during app.shutdown().
+async def drain_application(app, drain_timeout: float) -> bool:
+    stop_task = asyncio.create_task(app.stop())
+    done, _ = await asyncio.wait({stop_task}, timeout=drain_timeout)
+    if not done:
+        stop_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await stop_task
+    return bool(done)
+
+
 
+# Building the application with all handlers
+# Worker processes get updates from the supervisor (worker_pool.py), so they are built without an updater
+# and share the global Telegram rate between them.
+def build_application(updater: bool = True, workers: int = 1):
     # Telegram timeouts
     request = HTTPXRequest(
         connect_timeout=CONNECT_TIMEOUT,
         read_timeout=READ_TIMEOUT
     )
-    app = ApplicationBuilder().concurrent_updates(True).token(bot_state.bot_token).request(request).build()
+    # All outbound calls go through one rate limiter (flood limits, RetryAfter)
+    builder = ApplicationBuilder().concurrent_updates(True).token(bot_state.bot_token).request(request) \
+        .rate_limiter(OutboundRateLimiter(global_rate=TELEGRAM_GLOBAL_RATE / workers))
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Handlers
     # Registering handlers for different commands and messages
     register_handlers(app)
+    return app
+
+
+
+# Main function to run the bot
+# This function initializes the bot, loads roles and history, and starts the bot.
+async def main(profile_startup: bool = False, workers: int = None):
+    startup_profiler.mark("импорт модулей")
+
+    init_config()
+    if workers:
+        bot_state.config.setdefault("runtime", {})["workers"] = workers
+    errors = validate_config(bot_state.config)
+    if errors:
+        raise ValueError("Ошибки в config.json:\n" + "\n".join(errors))
+
+    # Supervisor mode: updates are routed to worker processes by user id
+    workers = bot_state.config.get("runtime", {}).get("workers", 1)
+    bot_state.workers = workers
+    if workers > 1:
+        if not bot_state.bot_token:
+            raise ValueError("Не указан токен бота в config.json!")
+        from worker_pool import run_supervisor
+        await run_supervisor(workers)
+        return
+
+    # tokenizers are loaded in the background while the bot starts
+    warm_up_tokenizers(list(bot_state.config.get("services", {}).values()))
+    startup_profiler.mark("конфигурация")
+
+    if not bot_state.bot_token:
+        raise ValueError("Не указан токен бота в config.json!")
+
+    init_state_backend()
+    load_roles()
+    load_history()
+    startup_profiler.mark("роли и история")
+
+    app = build_application()
+    startup_profiler.mark("сборка приложения")
 
     await app.bot.set_my_commands(get_bot_commands())
 
@@ -51,6 +134,7 @@ async def main():
         print("💾 Сохраняю историю и роли перед завершением...")
         save_history()
         save_roles()
+        bot_state.backend.close()
         print("✅ История и роли сохранены.")
         print("🔚 Завершение работы.")
     app.post_shutdown = shutdown_callback
@@ -60,24 +144,58 @@ async def main():
     # Initialize the bot
     await app.initialize()   # Preparing the bot (loading data, etc.)
     await app.start()        # Running the bot (starting background tasks, etc.)
-
-    # Polling
-    # This is the main loop that checks for new messages and updates
-    polling_task = asyncio.create_task(app.updater.start_polling())
-    print("Бот запущен 🚀")
+    typing_ticker.start(app.bot)
+    loop_monitor.start()
+    startup_profiler.mark("запуск приложения")
+
+    # Stop on SIGTERM/SIGINT (not available on Windows, there Ctrl+C cancels main())
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    # Reload config.json and credentials.json on SIGHUP (no SIGHUP on Windows: use /reload)
+    if hasattr(signal, "SIGHUP"):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signal.SIGHUP, reload_config)
+
+    # Runtime mode: polling (default) or webhook
+    runtime = bot_state.config.get("runtime", {})
+    mode = runtime.get("mode", "polling")
+    webhook_config = runtime.get("webhook", {})
+
+    polling_task = None
+    if mode == "webhook":
+        await start_webhook(app, webhook_config)
+        print(f"Бот запущен в режиме webhook на порту {webhook_config.get('port', 8443)} 🚀")
+    else:
+        # Polling
+        # This is the main loop that checks for new messages and updates
+        polling_task = asyncio.create_task(app.updater.start_polling())
+        print("Бот запущен 🚀")
+    startup_profiler.mark("приём обновлений")
+    if profile_startup:
+        startup_profiler.report()
     
     # Waiting for the bot to be stopped
-    # This is a future that never completes, so the bot will run indefinitely
     try:
-        await asyncio.Future()  # This is a future that never completes
+        await stop_event.wait()
     except asyncio.CancelledError:
         pass
     finally:
-        polling_task.cancel()
-        with contextlib.suppress(asyncio.CancelledError):
-            await polling_task
-        await app.updater.stop()  # Stop the updater
-        await app.stop()          # Stop the bot
+        if polling_task:
+            polling_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await polling_task
+        await app.updater.stop()  # Stop the updater (no new updates are accepted)
+
+        # Draining: updates that are already being processed are finished, then the bot is stopped
+        drain_timeout = get_drain_timeout(runtime)
+        print("⏳ Жду завершения текущих запросов...")
+        if not await drain_application(app, drain_timeout):
+            print(f"⚠️ Запросы не завершились за {drain_timeout} с, останавливаюсь принудительно.")
+        await typing_ticker.stop()
+        await loop_monitor.stop()
         await app.shutdown()      # Stop the bot and clean up resources
         # post_shutdown-callback
         # This callback is called after the bot is stopped
@@ -89,5 +207,9 @@ async def main():
 
 # Bot startup
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="BotAnya Telegram bot.")
+    parser.add_argument("--profile-startup", action="store_true", help="print durations of the startup phases")
+    parser.add_argument("--workers", type=int, help="number of worker processes (overrides runtime.workers)")
+    args = parser.parse_args()
+    asyncio.run(main(profile_startup=args.profile_startup, workers=args.workers))
 
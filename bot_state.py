@@ -8,8 +8,10 @@
 import json
 import os
 import asyncio
-import tiktoken
-from config import (CONFIG_FILE, CREDENTIALS_FILE, SCENARIOS_DIR, ROLES_FILE, HISTORY_FILE, LOG_DIR, TIKTOKEN_ENCODING)
+from config import (CONFIG_FILE, CREDENTIALS_FILE, SCENARIOS_DIR, LOG_DIR)
+from turns import ROLE_USER, ROLE_CHAR, PackedHistory, turn_from_json
+from snapshot import SnapshotRecord
+from state_backend import create_state_backend
 from datetime import datetime
 
 
@@ -25,8 +27,12 @@ class BotState:
         self.debug_mode = True
         self.bot_token = ""
         self.user_locks = {}
-        self.encoding = None
         self.pending_messages = {}  # user_id -> list of (text, original_text, buttons)
+        self.history_versions = {}  # (user_id, scenario_file) -> change counter of the history
+        self.backend = None         # StateBackend
+        self.dirty_roles = set()      # user ids with roles/world info changed since the last save
+        self.dirty_histories = set()  # (user_id, scenario_file) changed since the last save
+        self.workers = 1              # worker processes sharing the service limits (supervisor mode)
 
         self.test_network_fail_once = True  # или True для одного запуска
 
@@ -54,12 +60,14 @@ class BotState:
             role_data["service"] = service
 
         self.user_roles[user_id] = role_data
+        self.dirty_roles.add(user_id)
 
 
     def clear_user_role(self, user_id):
         user_id = str(user_id)
         if user_id in self.user_roles:
             self.user_roles[user_id]["role"] = None
+            self.dirty_roles.add(user_id)
 
 
     # Function to get user character and world
@@ -97,10 +105,10 @@ class BotState:
         return char, world, characters, scenario_file, None
 
 
-    def get_user_service_config(self, user_id):
+    def get_user_service_config(self, user_id, service_key=None):
         user_id = str(user_id)
         user_entry = self.user_roles.get(user_id, {})
-        service_key = user_entry.get("service", self.config.get("default_service"))
+        service_key = service_key or user_entry.get("service", self.config.get("default_service"))
         services = self.config.get("services", {})
         if not services and self.debug_mode:
             print(f"⚠️ [DEBUG] Сервис '{service_key}' не найден в config.json!")
@@ -120,22 +128,90 @@ class BotState:
 
 
     # === HISTORY ===
+    # Scenario histories of the user, loaded from the backend or decoded from the snapshot on first access
+    def _user_scenarios(self, user_id: str) -> dict:
+        scenarios = self.user_history.get(user_id)
+        if scenarios is None:
+            scenarios = self.user_history[user_id] = self.backend.load_user_histories(user_id) \
+                if self.backend and self.backend.lazy else {}
+            _load_turns({user_id: scenarios})
+        elif isinstance(scenarios, SnapshotRecord):
+            scenarios = self.user_history[user_id] = scenarios.decode()
+            _load_turns({user_id: scenarios})
+        return scenarios
+
+
+    # Reading only: changes go through update_user_history() / set_summary(), which mark the record for saving
     def get_user_history(self, user_id, scenario_file):
-        return self.user_history.setdefault(str(user_id), {}).setdefault(scenario_file, {
+        scenarios = self._user_scenarios(str(user_id))
+        data = scenarios.setdefault(scenario_file, {
             "history": [],
             "last_input": "",
             "last_bot_id": None
         })
+        # Inactive scenario history is kept compressed until it is needed again
+        if isinstance(data, PackedHistory):
+            data = scenarios[scenario_file] = data.unpack()
+            self.dirty_histories.add((str(user_id), scenario_file))
+        return data
+
+
+    # Compressing histories of all scenarios except the active one
+    def pack_inactive_histories(self, user_id):
+        user_id = str(user_id)
+        role_entry = self.user_roles.get(user_id) or {}
+        active = role_entry.get("scenario")
+        scenarios = self.user_history.get(user_id, {})
+        # a record not decoded from the snapshot yet is kept as it was saved
+        if isinstance(scenarios, SnapshotRecord):
+            return
+        for scenario_file, data in scenarios.items():
+            if scenario_file != active and not isinstance(data, PackedHistory):
+                scenarios[scenario_file] = PackedHistory.pack(data)
+                self.dirty_histories.add((user_id, scenario_file))
 
 
     def update_user_history(self, user_id, scenario_file, history, last_input="", last_bot_id=None):
         data = self.get_user_history(user_id, scenario_file)
         data["history"] = history
+        # the history was cut (/retry, /edit) below the summarized turns: the summary is stale
+        if data.get("summary", {}).get("turns", 0) > len(history):
+            del data["summary"]
         if last_input:
             data["last_input"] = last_input
         if last_bot_id is not None:
             data["last_bot_id"] = last_bot_id
         self.user_history[str(user_id)][scenario_file] = data
+        self.dirty_histories.add((str(user_id), scenario_file))
+        self.bump_history_version(user_id, scenario_file)
+
+
+    # Summary of the first turns (summarizer.py): the turns themselves don't change,
+    # so the history version (and the caches keyed on it, like /retry alternates) stays
+    def set_summary(self, user_id, scenario_file, summary: dict):
+        data = self.get_user_history(user_id, scenario_file)
+        data["summary"] = summary
+        self.dirty_histories.add((str(user_id), scenario_file))
+
+
+    def reset_user_history(self, user_id, scenario_file):
+        self.dirty_histories.add((str(user_id), scenario_file))
+        self._user_scenarios(str(user_id))[scenario_file] = {
+            "history": [],
+            "last_input": "",
+            "last_bot_id": None
+        }
+        self.bump_history_version(user_id, scenario_file)
+
+
+    # History version is used as a key for caches built from the history
+    def get_history_version(self, user_id, scenario_file) -> int:
+        return self.history_versions.get((str(user_id), scenario_file), 0)
+
+
+    def bump_history_version(self, user_id, scenario_file):
+        key = (str(user_id), scenario_file)
+        self.history_versions[key] = self.history_versions.get(key, 0) + 1
 
 
 
@@ -205,6 +281,7 @@ class BotState:
     # === WORLD_INFO ===
     def set_world_info(self, user_id, world_data):
         self.user_world_info[str(user_id)] = world_data
+        self.dirty_roles.add(str(user_id))
 
 
     def get_world_info(self, user_id):
@@ -215,13 +292,13 @@ class BotState:
     def is_valid_last_exchange(self, user_id, scenario_file, char_name, user_name):
         data = self.get_user_history(user_id, scenario_file)
         history = data.get("history", [])
-        user_prefix = f"{user_name}:"
-        assistant_prefix = f"{char_name}:"
 
         if len(history) < 2:
             return False
 
-        return history[-2].startswith(user_prefix) and history[-1].startswith(assistant_prefix)
+        user_turn, char_turn = history[-2], history[-1]
+        return (user_turn.role == ROLE_USER and user_turn.speaker == user_name
+                and char_turn.role == ROLE_CHAR and char_turn.speaker == char_name)
 
 
     ## === STRINGS ===
@@ -245,15 +322,26 @@ bot_state = BotState()
 
 # Configuration and scenario loading
 def init_config():
-    bot_state.config, bot_state.credentials = load_config()
-    bot_state.debug_mode = bot_state.config.get("debug_mode", True)
-    bot_state.bot_token = bot_state.credentials.get("telegram_bot_token", "")
-    bot_state.encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+    apply_config(*load_config())
     if bot_state.debug_mode:
         print("📦 Конфигурация загружена.")
 
 
 
+# Swapping config and credentials (at start and on reload)
+def apply_config(config: dict, credentials: dict):
+    """
+    Both dicts are replaced at once; requests that are already running keep
+    the service_config they got before. The bot token is taken only once: the
+    running application can't switch to another bot.
+    """
+    bot_state.config, bot_state.credentials = config, credentials
+    bot_state.debug_mode = config.get("debug_mode", True)
+    if not bot_state.bot_token:
+        bot_state.bot_token = credentials.get("telegram_bot_token", "")
+
+
+
 # Loading configuration from config file and credentials
 def load_config():
     if not os.path.exists(CONFIG_FILE):
@@ -263,8 +351,8 @@ def load_config():
         data = json.load(f)
 
     if data.get("debug_mode", True):
-        print("🛠️ [DEBUG] Загружен config.json:")
-        print(json.dumps(data, indent=2, ensure_ascii=False))
+        services = ", ".join(data.get("services", {})) or "нет"
+        print(f"🛠️ [DEBUG] Загружен config.json: сервисы {services}, по умолчанию {data.get('default_service')}")
 
     # Loading credentials
     if not os.path.exists(CREDENTIALS_FILE):
@@ -273,9 +361,9 @@ def load_config():
     with open(CREDENTIALS_FILE, "r", encoding="utf-8") as f:
         credentials = json.load(f)
 
+    # only the names: credentials are never printed
     if data.get("debug_mode", True):
-        print("🛠️ [DEBUG] Загружены credentials.json:")
-        print(json.dumps(credentials, indent=2, ensure_ascii=False))
+        print(f"🛠️ [DEBUG] Загружены credentials.json: {', '.join(credentials) or 'пусто'}")
 
     return data, credentials
 
@@ -297,34 +385,70 @@ def load_characters(scenario_path: str):
 
 
 
-# Loading roles from roles file
+# State storage chosen by "state_backend" (and "state_format") of config.json
+def init_state_backend():
+    bot_state.backend = create_state_backend(bot_state.config)
+    if bot_state.debug_mode:
+        print(f"🗄️ Хранилище состояния: {type(bot_state.backend).__name__}")
+
+
+
+# Loading roles (and world info) from the state backend
 def load_roles():
-    if os.path.exists(ROLES_FILE):
-        with open(ROLES_FILE, "r", encoding="utf-8") as f:
-            bot_state.user_roles = json.load(f)
-    else:
-        bot_state.user_roles = {}         
+    bot_state.user_roles = bot_state.backend.load_roles()
+    bot_state.user_world_info = bot_state.backend.load_world_info()
 
 
 
-# Saving roles to roles file
+# Saving changed roles and world info
 def save_roles():
-    with open(ROLES_FILE, "w", encoding="utf-8") as f:
-        json.dump(bot_state.user_roles, f, ensure_ascii=False, indent=2)
+    dirty, bot_state.dirty_roles = bot_state.dirty_roles, set()
+    bot_state.backend.save_roles(bot_state.user_roles, dirty)
+    bot_state.backend.save_world_info(bot_state.user_world_info, dirty)
+
 
 
+# User name and character names of a scenario (to parse old "Name: text" entries)
+def _scenario_speakers(scenario_file: str, cache: dict):
+    if scenario_file not in cache:
+        try:
+            characters, world = load_characters(os.path.join(SCENARIOS_DIR, scenario_file))
+            cache[scenario_file] = (world.get("user_name", "Пользователь"),
+                                    [char.get("name", "") for char in characters.values()])
+        except Exception:
+            cache[scenario_file] = ("Пользователь", [])
+    return cache[scenario_file]
+
 
-## Loading user history from history file
+
+# User name and character names of scenarios, for _load_turns
+_speakers_cache = {}
+
+
+
+# Converting history entries to Turn objects (old string entries are parsed)
+def _load_turns(user_history: dict):
+    for scenarios in user_history.values():
+        if isinstance(scenarios, SnapshotRecord):
+            continue
+        for scenario_file, data in scenarios.items():
+            if "zlib" in data:
+                scenarios[scenario_file] = PackedHistory.from_json(data)
+                continue
+            user_name, char_names = _scenario_speakers(scenario_file, _speakers_cache)
+            data["history"] = [turn_from_json(entry, user_name, char_names) for entry in data.get("history", [])]
+
+
+
+## Loading user history from the state backend (lazy backends load it per user later)
 def load_history():
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            bot_state.user_history = json.load(f)
-    else:
-        bot_state.user_history = {}
+    bot_state.user_history = bot_state.backend.load_histories()
+    _load_turns(bot_state.user_history)
+    for user_id in bot_state.user_history:
+        bot_state.pack_inactive_histories(user_id)
 
 
-# Saving user history to history file
+# Saving changed histories
 def save_history():
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(bot_state.user_history, f, ensure_ascii=False, indent=2)
-
+    dirty, bot_state.dirty_histories = bot_state.dirty_histories, set()
+    bot_state.backend.save_histories(bot_state.user_history, dirty)
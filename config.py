@@ -15,6 +15,11 @@ CREDENTIALS_FILE = os.path.join(BASE_DIR, "secrets", "credentials.json")
 SCENARIOS_DIR = os.path.join(BASE_DIR, "scenarios")
 ROLES_FILE = os.path.join(BASE_DIR, "user_roles.json")
 HISTORY_FILE = os.path.join(BASE_DIR, "history.json")
+# Snapshots used instead of the two files above with "state_format": "snapshot"
+ROLES_SNAPSHOT_FILE = os.path.join(BASE_DIR, "user_roles.snap")
+HISTORY_SNAPSHOT_FILE = os.path.join(BASE_DIR, "history.snap")
+# SQLite database of the "sqlite" state backend
+STATE_DB_FILE = os.path.join(BASE_DIR, "state.db")
 LOG_DIR = os.path.join(BASE_DIR, "chat_logs")
 
 #Telegram parametrs
@@ -22,13 +27,45 @@ LOG_DIR = os.path.join(BASE_DIR, "chat_logs")
 MAX_LENGTH = 4096
 CONNECT_TIMEOUT = 10.0
 READ_TIMEOUT = 20.0
+# Time to finish in-flight updates on shutdown
+DRAIN_TIMEOUT = 60.0  # seconds
+# Supervisor mode: a worker process that exited is started again after this delay
+WORKER_RESTART_DELAY = 5.0  # seconds
+# Supervisor mode: time for a worker to save the state after draining, before it is killed
+WORKER_SAVE_TIMEOUT = 30.0  # seconds
+# Outbound flood limits of Telegram Bot API
+TELEGRAM_GLOBAL_RATE = 30      # messages per second for the whole bot
+TELEGRAM_CHAT_RATE = 1.0       # messages per second in one private chat
+TELEGRAM_CHAT_BURST = 3        # short burst allowed in one chat
+TELEGRAM_GROUP_RATE = 20 / 60  # messages per second in one group
+# Number of resends after RetryAfter
+TELEGRAM_MAX_RETRIES = 3
+# Interval of "typing..." actions (Telegram shows the indicator for 5 seconds)
+TYPING_INTERVAL = 5.0  # seconds
+# Pause after a user message before the generation starts (next messages are merged into it)
+INPUT_DEBOUNCE = 1.5  # seconds
+# Max wait after the first message of a burst
+INPUT_DEBOUNCE_MAX = 5.0  # seconds
 
 #Ollama parametrs
 # Time of keep-alive for Ollama models
 # controls how long the model will stay loaded into memory following the request
+# (upper limit for models that are not pinned, see ollama_keep_alive.py)
 OLLAMA_KEEP_ALIVE = 1200  # seconds
+# Lower limit of keep-alive for rarely used models
+OLLAMA_KEEP_ALIVE_MIN = 120  # seconds
+# Window for measuring the request rate of a model
+OLLAMA_RATE_WINDOW = 1800  # seconds
+# Requests in the window after which the model is pinned in memory
+OLLAMA_HOT_REQUESTS = 10
+# Idle time after which a model is unloaded when another model is requested
+OLLAMA_UNLOAD_IDLE = 120  # seconds
 # max number of concurrent requests to Ollama API
 OLLAMA_SEMAPHORE = 5  
+# Context sizes (num_ctx) a request is rounded up to; capped by service max_tokens
+OLLAMA_NUM_CTX_BUCKETS = (2048, 4096, 8192, 16384, 32768)
+# Reserve for the difference between tiktoken count and the model tokenizer
+OLLAMA_NUM_CTX_MARGIN = 1.15
 
 #GigaChat parametrs
 # max number of concurrent requests to GigaChat API
@@ -42,6 +79,43 @@ OPENAI_SEMAPHORE = 10
 
 # encoding for tokens count
 TIKTOKEN_ENCODING = "gpt2"
+# Warn when our prompt token counts differ from prompt_eval_count of Ollama by this share on average
+TOKENIZER_DRIFT_WARN = 0.15
+# Number of Ollama requests the average drift is computed over
+TOKENIZER_DRIFT_SAMPLES = 20
+# Threads counting tokens outside of the event loop
+TOKENIZER_THREADS = 4
+# Number of history turns counted in one batch
+TOKENIZER_BATCH = 64
+# Number of cached token counts of system/scene prompts
+PROMPT_TOKENS_CACHE_SIZE = 1024
+# Number of users with cached rendered prompt blocks
+PROMPT_CACHE_USERS = 512
+# Default token budget for dialogue history in scene prompts
+SCENE_HISTORY_TOKENS = 1500
+
+# Long-term memory (retrieval of trimmed history turns)
+MEMORY_DIM = 1024           # size of hashed term vectors
+MEMORY_STEM_LENGTH = 6      # words are cut to this length before hashing
+MEMORY_TOP_K = 4            # max number of recalled turns
+MEMORY_MIN_SCORE = 0.12     # min cosine similarity of a recalled turn
+MEMORY_MAX_INDEXES = 256    # histories with an index kept in memory
+
+# Rolling summary of trimmed history
+SUMMARY_MIN_TURNS = 6       # trimmed turns that trigger a summary update
+SUMMARY_MAX_TURNS = 40      # max turns folded into the summary by one job
+SUMMARY_MIN_WORDS = 50      # lower limit of the requested summary length
 
 # Maximum text fragment size for translator
-MAX_PART_SIZE = 4000
\ No newline at end of file
+MAX_PART_SIZE = 4000
+# Minimum size of a streamed fragment sent to the translator
+STREAM_TRANSLATE_MIN_CHARS = 40
+# Minimum interval between edits of a message with streamed text
+STREAM_EDIT_INTERVAL = 1.5  # seconds
+
+
+
+# Event loop lag monitor (seconds): check interval, lag printed in debug mode, period of the summary
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WARN = 0.1
+LOOP_LAG_REPORT = 300
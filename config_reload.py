@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# config_reload.py
+# This file is part of the BotAnya Telegram Bot project.
+# Checking config.json and applying it without restarting the bot (SIGHUP, /reload).
+
+import importlib.util
+from numbers import Number
+from bot_state import bot_state, load_config, apply_config
+from service_clients import SERVICE_CLIENT_MODULES, SERVICE_CONCURRENCY, apply_concurrency
+from tokenizers_registry import warm_up_tokenizers
+
+# Service settings that must be numbers / non-negative integers
+NUMBER_SETTINGS = ("temperature", "top_p", "min_p", "repeat_penalty", "frequency_penalty", "presence_penalty")
+INTEGER_SETTINGS = ("num_predict", "max_tokens", "timeout", "scene_tokens", "memory_tokens", "summary_tokens",
+                    "n_candidates")
+
+
+
+# Problems of the config; an empty list means the config can be applied
+# (workers: the number of running worker processes, runtime.workers of this config if not given)
+def validate_config(config: dict, workers: int = None) -> list:
+    errors = []
+    services = config.get("services")
+    if not isinstance(services, dict) or not services:
+        return ["services: нет ни одного сервиса"]
+    if config.get("default_service") not in services:
+        errors.append(f"default_service: сервис '{config.get('default_service')}' не найден")
+
+    for key, service in services.items():
+        if not isinstance(service, dict):
+            errors.append(f"{key}: настройки сервиса должны быть объектом")
+            continue
+        if service.get("type") not in SERVICE_CLIENT_MODULES:
+            errors.append(f"{key}: неизвестный type '{service.get('type')}'")
+        if not service.get("model"):
+            errors.append(f"{key}: не указан model")
+        for name in NUMBER_SETTINGS:
+            value = service.get(name)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, Number)):
+                errors.append(f"{key}.{name}: ожидается число")
+        for name in INTEGER_SETTINGS:
+            value = service.get(name)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+                errors.append(f"{key}.{name}: ожидается целое число ≥ 0")
+        if service.get("summary_service") and service["summary_service"] not in services:
+            errors.append(f"{key}.summary_service: сервис '{service['summary_service']}' не найден")
+
+    concurrency = config.get("concurrency", {})
+    if not isinstance(concurrency, dict):
+        errors.append("concurrency: ожидается объект {тип сервиса: число запросов}")
+    else:
+        for service_type, limit in concurrency.items():
+            if service_type not in SERVICE_CLIENT_MODULES:
+                errors.append(f"concurrency.{service_type}: неизвестный тип сервиса")
+            elif isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+                errors.append(f"concurrency.{service_type}: ожидается целое число ≥ 1")
+
+    mode = config.get("runtime", {}).get("mode", "polling")
+    if mode not in ("polling", "webhook"):
+        errors.append("runtime.mode: ожидается \"polling\" или \"webhook\"")
+    elif mode == "webhook" and importlib.util.find_spec("tornado") is None:
+        errors.append("runtime.mode: для webhook нужен пакет python-telegram-bot[webhooks] "
+                      "(pip install -r requirements.txt)")
+
+    config_workers = config.get("runtime", {}).get("workers", 1)
+    if isinstance(config_workers, bool) or not isinstance(config_workers, int) or config_workers < 1:
+        errors.append("runtime.workers: ожидается целое число ≥ 1")
+    elif (workers or config_workers) > 1:
+        workers = workers or config_workers
+        if config.get("state_backend", "file") != "sqlite":
+            errors.append("runtime.workers: несколько процессов работают только с state_backend \"sqlite\"")
+        # every worker needs at least one request slot of its own, otherwise the limit would be exceeded
+        service_types = {service.get("type") for service in services.values() if isinstance(service, dict)}
+        for service_type in sorted(service_types & set(SERVICE_CONCURRENCY)):
+            if not isinstance(concurrency, dict):
+                break
+            limit = concurrency.get(service_type, SERVICE_CONCURRENCY[service_type])
+            if isinstance(limit, int) and limit < workers:
+                errors.append(f"runtime.workers: concurrency.{service_type} = {limit} меньше числа процессов ({workers})")
+
+    if config.get("state_backend", "file") not in ("file", "sqlite"):
+        errors.append("state_backend: ожидается \"file\" или \"sqlite\"")
+    if config.get("state_format", "json") not in ("json", "snapshot"):
+        errors.append("state_format: ожидается \"json\" или \"snapshot\"")
+    if not isinstance(config.get("admins", []), list):
+        errors.append("admins: ожидается список id пользователей")
+    return errors
+
+
+
+# Called after a successful /reload (a worker process asks the supervisor to reload the other workers)
+reload_listeners = []
+
+
+
+# Re-reading config.json and credentials.json; returns the problems (the old config stays then)
+def reload_config(notify: bool = False) -> list:
+    try:
+        config, credentials = load_config()
+    except (OSError, ValueError) as e:
+        errors = [str(e)]
+    else:
+        # the number of processes changes only on restart, so the running one is checked
+        errors = validate_config(config, workers=bot_state.workers)
+    if errors:
+        print("⚠️ Конфигурация не применена:\n" + "\n".join(errors))
+        return errors
+
+    if credentials.get("telegram_bot_token", "") != bot_state.bot_token:
+        print("⚠️ Токен бота изменился: он будет применён только после перезапуска.")
+
+    apply_config(config, credentials)
+    apply_concurrency()
+    warm_up_tokenizers(list(config["services"].values()))
+    print("🔄 Конфигурация перезагружена.")
+    if notify:
+        for listener in reload_listeners:
+            listener()
+    return []
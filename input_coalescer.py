@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# input_coalescer.py
+# This file is part of the BotAnya Telegram Bot project.
+# Merging messages sent in a quick burst into one user turn.
+
+import asyncio
+from config import INPUT_DEBOUNCE, INPUT_DEBOUNCE_MAX
+
+
+
+class _UserInput:
+    __slots__ = ("texts", "callback", "first_at", "timer", "busy")
+
+    def __init__(self):
+        self.texts = []        # messages waiting for the next generation, in order
+        self.callback = None   # generation for the latest message
+        self.first_at = None   # loop time of the first waiting message
+        self.timer = None      # debounce task
+        self.busy = False      # generation is running
+
+
+
+class InputCoalescer:
+    """
+    Waits INPUT_DEBOUNCE seconds after each message (but no longer than INPUT_DEBOUNCE_MAX
+    after the first one) and then starts one generation for all waiting messages.
+    Messages that arrive during a generation are merged into the next one.
+    """
+
+    def __init__(self, debounce: float = INPUT_DEBOUNCE, max_wait: float = INPUT_DEBOUNCE_MAX):
+        self._debounce = debounce
+        self._max_wait = max_wait
+        self._users = {}   # user_id -> _UserInput
+
+
+    # Adding a message; callback(text) runs the generation for the merged text
+    def submit(self, user_id: str, text: str, callback, create_task=asyncio.create_task):
+        state = self._users.setdefault(user_id, _UserInput())
+        now = asyncio.get_running_loop().time()
+        state.texts.append(text)
+        state.callback = callback
+        if state.first_at is None:
+            state.first_at = now
+
+        if state.busy:
+            return
+        if state.timer and not state.timer.done():
+            state.timer.cancel()
+        delay = min(self._debounce, state.first_at + self._max_wait - now)
+        state.timer = create_task(self._flush_later(user_id, state, delay, create_task))
+
+
+    async def _flush_later(self, user_id: str, state: _UserInput, delay: float, create_task):
+        await asyncio.sleep(max(delay, 0.0))
+
+        # from here on the task is not cancelled by new messages
+        state.busy = True
+        text = "\n".join(state.texts)
+        callback = state.callback
+        state.texts = []
+        state.callback = None
+        state.first_at = None
+        try:
+            await callback(text)
+        finally:
+            state.busy = False
+            if state.texts:
+                delay = min(self._debounce, state.first_at + self._max_wait - asyncio.get_running_loop().time())
+                state.timer = create_task(self._flush_later(user_id, state, delay, create_task))
+            else:
+                self._users.pop(user_id, None)
+
+
+
+# InputCoalescer instance
+input_coalescer = InputCoalescer()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# loop_monitor.py
+# This file is part of the BotAnya Telegram Bot project.
+# Event loop lag: how late the loop wakes up a sleeping task (blocking code in handlers shows up here).
+
+import asyncio
+import contextlib
+from bot_state import bot_state
+from config import LOOP_LAG_INTERVAL, LOOP_LAG_WARN, LOOP_LAG_REPORT
+
+
+
+class LoopLagMonitor:
+    """
+    Sleeps LOOP_LAG_INTERVAL seconds in a loop and measures how much later it is woken up.
+    In debug mode single lags of LOOP_LAG_WARN seconds and more are printed,
+    and every LOOP_LAG_REPORT seconds the average and max lag of the period.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self._interval = interval
+        self._task = None
+        self.last = 0.0      # lag of the last check
+        self.max = 0.0       # max lag of the current period
+        self._total = 0.0
+        self._checks = 0
+
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+    # Average and max lag of the current period
+    def stats(self) -> dict:
+        average = self._total / self._checks if self._checks else 0.0
+        return {"last": self.last, "average": average, "max": self.max, "checks": self._checks}
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        period_start = loop.time()
+        while True:
+            expected = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            now = loop.time()
+            self.last = max(now - expected, 0.0)
+            self.max = max(self.max, self.last)
+            self._total += self.last
+            self._checks += 1
+
+            if bot_state.debug_mode and self.last >= LOOP_LAG_WARN:
+                print(f"🐢 Event loop задержан на {self.last * 1000:.0f} мс")
+
+            if now - period_start >= LOOP_LAG_REPORT:
+                if bot_state.debug_mode:
+                    stats = self.stats()
+                    print(f"🐢 Задержка event loop за {LOOP_LAG_REPORT // 60} мин: "
+                          f"в среднем {stats['average'] * 1000:.1f} мс, максимум {stats['max'] * 1000:.0f} мс")
+                period_start = now
+                self.max = self._total = 0.0
+                self._checks = 0
+
+
+
+# LoopLagMonitor instance
+loop_monitor = LoopLagMonitor()
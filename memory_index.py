@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# memory_index.py
+# This file is part of the BotAnya Telegram Bot project.
+# Long-term memory: retrieval of old history turns that were trimmed out of the prompt.
+
+import re
+import zlib
+from collections import OrderedDict
+from typing import List
+import numpy as np
+from config import MEMORY_DIM, MEMORY_STEM_LENGTH, MEMORY_TOP_K, MEMORY_MIN_SCORE, MEMORY_MAX_INDEXES
+from turns import Turn
+from utils import count_turn_tokens
+
+_WORD_RE = re.compile(r"\w+")
+
+
+
+# Hashed term counts of the text
+def _vectorize(text: str, dim: int = MEMORY_DIM) -> np.ndarray:
+    """
+    Words are cut to MEMORY_STEM_LENGTH characters (a cheap stemmer that works for Russian endings)
+    and hashed into dim buckets; the result is log(1 + tf).
+    """
+    words = [word[:MEMORY_STEM_LENGTH] for word in _WORD_RE.findall(text.lower()) if len(word) > 2]
+    if not words:
+        return np.zeros(dim, dtype=np.float32)
+    buckets = np.fromiter((zlib.crc32(word.encode("utf-8")) % dim for word in words), dtype=np.int64, count=len(words))
+    return np.log1p(np.bincount(buckets, minlength=dim).astype(np.float32))
+
+
+
+class MemoryIndex:
+    """
+    TF-IDF (hashing) index of the turns of one history.
+    Rows follow the history list: sync() keeps the common prefix (by turn identity)
+    and vectorizes only new turns, so appends are incremental.
+    """
+
+    def __init__(self, dim: int = MEMORY_DIM):
+        self._dim = dim
+        self._turns = []
+        self._rows = np.zeros((64, dim), dtype=np.float32)
+        self._df = np.zeros(dim, dtype=np.float32)   # document frequency of each bucket
+
+
+    def __len__(self):
+        return len(self._turns)
+
+
+    def sync(self, history: List[Turn]):
+        common = 0
+        limit = min(len(self._turns), len(history))
+        while common < limit and self._turns[common] is history[common]:
+            common += 1
+
+        # removed or replaced turns (retry, edit)
+        if common < len(self._turns):
+            self._df -= (self._rows[common:len(self._turns)] > 0).sum(axis=0)
+            del self._turns[common:]
+
+        for turn in history[common:]:
+            self._append(turn)
+
+
+    def _append(self, turn: Turn):
+        size = len(self._turns)
+        if size == len(self._rows):
+            grown = np.zeros((size * 2, self._dim), dtype=np.float32)
+            grown[:size] = self._rows
+            self._rows = grown
+        row = _vectorize(turn.text, self._dim)
+        self._rows[size] = row
+        self._df += row > 0
+        self._turns.append(turn)
+
+
+    # Positions of the most relevant turns among the first `limit` ones, best first
+    def search(self, query: str, limit: int, top_k: int = MEMORY_TOP_K,
+               min_score: float = MEMORY_MIN_SCORE) -> List[int]:
+        limit = min(limit, len(self._turns))
+        if limit <= 0:
+            return []
+
+        idf = np.log((len(self._turns) + 1) / (self._df + 1)) + 1
+        query_vec = _vectorize(query, self._dim) * idf
+        query_norm = np.linalg.norm(query_vec)
+        if not query_norm:
+            return []
+
+        matrix = self._rows[:limit] * idf
+        scores = matrix @ query_vec / (np.linalg.norm(matrix, axis=1) * query_norm + 1e-9)
+
+        top_k = min(top_k, limit)
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [int(i) for i in best if scores[i] >= min_score]
+
+
+
+class MemoryStore:
+    """
+    Indexes of recently used histories: (user_id, scenario_file) -> MemoryIndex.
+    Indexes are rebuilt from the history when needed, so they are not saved.
+    """
+
+    def __init__(self, max_indexes: int = MEMORY_MAX_INDEXES):
+        self._max_indexes = max_indexes
+        self._indexes = OrderedDict()
+
+
+    def get(self, user_id: str, scenario_file: str, history: List[Turn]) -> MemoryIndex:
+        key = (str(user_id), scenario_file)
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = MemoryIndex()
+            while len(self._indexes) > self._max_indexes:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(key)
+        index.sync(history)
+        return index
+
+
+    # Old turns (not in the trimmed window) relevant to the last turns, within max_tokens
+    def recall(self, user_id: str, scenario_file: str, history: List[Turn], window: int,
+               tokenizer, max_tokens: int, query_turns: int = 2) -> List[Turn]:
+        older = len(history) - window
+        if older <= 0 or max_tokens <= 0:
+            return []
+
+        index = self.get(user_id, scenario_file, history)
+        query = "\n".join(turn.text for turn in history[-query_turns:])
+
+        recalled, used = [], 0
+        for position in index.search(query, older):
+            tokens = count_turn_tokens(history[position], tokenizer)
+            if used + tokens > max_tokens:
+                continue
+            recalled.append(position)
+            used += tokens
+
+        # chronological order
+        return [history[position] for position in sorted(recalled)]
+
+
+
+# MemoryStore instance
+memory_store = MemoryStore()
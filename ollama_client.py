@@ -6,17 +6,110 @@
 # This file is part of the BotAnya Telegram Bot project.
 
 import json
+import contextlib
 import httpx
 import asyncio
+from bisect import bisect_left
 from httpx import RemoteProtocolError, ReadTimeout
-from config import OLLAMA_KEEP_ALIVE, OLLAMA_SEMAPHORE
+from config import OLLAMA_SEMAPHORE, OLLAMA_NUM_CTX_BUCKETS, OLLAMA_NUM_CTX_MARGIN
+from ollama_keep_alive import ollama_keep_alive, ollama_host
+from resizable_semaphore import ResizableSemaphore
+from utils import translate_messages, add_alternates
+from tokenizers_registry import get_tokenizer, count_tokens, tokenizer_drift
 
-ollama_semaphore = asyncio.Semaphore(OLLAMA_SEMAPHORE)
+ollama_semaphore = ResizableSemaphore(OLLAMA_SEMAPHORE)
 ollama_semaphore_lock = asyncio.Lock()
 ollama_waiting = []
 
+# (host, model) -> num_ctx of the loaded model
+ollama_num_ctx = {}
+
+# requests generating alternative answers in the background
+ollama_background_tasks = set()
+
+
+
+# Choosing num_ctx for the request
+def _pick_num_ctx(service_config: dict, api_url: str, prompt_tokens: int) -> int:
+    """
+    Rounds prompt tokens + num_predict up to the nearest bucket (capped by max_tokens).
+    A changed num_ctx makes Ollama reload the model, so the bucket is sticky per model:
+    it only grows while the model stays loaded and starts from scratch after it is unloaded.
+    """
+    max_tokens = service_config.get("max_tokens", 7000)
+    buckets = sorted(service_config.get("num_ctx_buckets", OLLAMA_NUM_CTX_BUCKETS))
+    needed = int(prompt_tokens * OLLAMA_NUM_CTX_MARGIN) + service_config.get("num_predict", 2048)
+
+    index = bisect_left(buckets, needed)
+    num_ctx = min(buckets[index] if index < len(buckets) else max_tokens, max_tokens)
+
+    model = service_config.get("model")
+    key = (ollama_host(api_url), model)
+    current = ollama_num_ctx.get(key)
+    if current and ollama_keep_alive.is_loaded(model, api_url):
+        num_ctx = max(num_ctx, min(current, max_tokens))
+    ollama_num_ctx[key] = num_ctx
+    return num_ctx
+
+
+
+# Reading streamed NDJSON response from Ollama
+async def _stream_ollama_response(client, api_url: str, payload: dict, on_delta, stats: dict = None) -> str:
+    parts = []
+    async with client.stream("POST", api_url, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            # /api/generate streams "response", /api/chat streams "message"
+            delta = chunk.get("response") or (chunk.get("message") or {}).get("content", "")
+            if delta:
+                parts.append(delta)
+                await on_delta(delta)
+            if chunk.get("done"):
+                # the final chunk carries the request statistics
+                if stats is not None:
+                    stats.update(chunk)
+                break
+    return "".join(parts).strip()
+
+
+
+# Plain (not streamed) request to Ollama
+async def _post_ollama(client, api_url: str, payload: dict, stats: dict = None) -> str:
+    response = await client.post(api_url, json=payload)
+    response.raise_for_status()
+    data = response.json()
+    if stats is not None:
+        stats.update(data)
+    # /api/generate returns "response", /api/chat returns "message"
+    return (data.get("response") or (data.get("message") or {}).get("content", "")).strip()
+
+
+
+# Generating one alternative answer for /retry; the caller has already taken a slot of ollama_semaphore
+async def _generate_alternate(api_url: str, payload: dict, service_config: dict, prompt_tokens: int,
+                              alternates: list, translate_func, debug: bool):
+    try:
+        try:
+            async with ollama_keep_alive.in_flight(payload["model"], api_url):
+                options = {**payload["options"], "num_ctx": _pick_num_ctx(service_config, api_url, prompt_tokens)}
+                async with httpx.AsyncClient(timeout=service_config.get("timeout", 90)) as client:
+                    text = await _post_ollama(client, api_url, {**payload, "stream": False, "options": options})
+        finally:
+            ollama_semaphore.release()
+        add_alternates(alternates, [text], translate_func)
+    except Exception as e:
+        if debug:
+            print(f"⚠️ Альтернативный ответ Ollama не получен: {e}")
+
+
+
 async def send_prompt_to_ollama(user_id: str, prompt: str, bot_state, use_translation: bool = False,
-                           translate_func=None, reverse_translate_func=None, get_position_only: bool = False) -> str:
+                           translate_func=None, reverse_translate_func=None, get_position_only: bool = False,
+                           stream_translator=None, decoding=None, messages=None, alternates=None,
+                           service_key=None) -> str:
     """
     Sends a prompt to the Ollama server and returns the response.
 
@@ -26,11 +119,20 @@ async def send_prompt_to_ollama(user_id: str, prompt: str, bot_state, use_transl
     :param translate_func: Function to translate the prompt to English.
     :param reverse_translate_func: Function to translate the response back.
     :param get_position_only: If True, returns only the queue position.
+    :param stream_translator: StreamingTranslator; if set together with use_translation, the response is streamed
+                              and translated sentence by sentence instead of reverse_translate_func.
+    :param decoding: Async context manager entered while the request is actually processed (after the queue),
+                     used to show the typing indicator.
+    :param messages: Chat messages ({"role", "content"}); used instead of prompt with /api/chat
+                     when the service has "chat_api" enabled.
+    :param alternates: List filled in the background with additional answers when the service has
+                       "n_candidates" > 1 (generated in free slots in parallel with the main request).
+    :param service_key: Service to use instead of the one selected by the user (background jobs).
     :return: The response string from the model, and the queue position (if semaphore is used).
     """
     
     # Getting user service configuration
-    service_config = bot_state.get_user_service_config(user_id)
+    service_config = bot_state.get_user_service_config(user_id, service_key)
     if not service_config or service_config.get("type") != "ollama":
         if bot_state.debug_mode:
             print("⚠️ Ollama не выбран или конфигурация отсутствует.")
@@ -38,16 +140,28 @@ async def send_prompt_to_ollama(user_id: str, prompt: str, bot_state, use_transl
 
 
     api_url = service_config.get("url", "http://localhost:11434/api/generate")
-    
+
+    # Chat endpoint: the model template is applied by Ollama
+    chat_api = bool(messages) and service_config.get("chat_api", False)
+    if chat_api:
+        api_url = service_config.get("chat_url") or api_url.replace("/api/generate", "/api/chat")
+
     # Translate prompt if use_translation is True
-    if use_translation and translate_func:
-        prompt = translate_func(prompt)
-    
+    if use_translation and translate_func and not get_position_only:
+        if chat_api:
+            messages = translate_messages(messages, translate_func)
+        else:
+            prompt = translate_func(prompt)
+
+    stream = bool(use_translation and stream_translator)
+    prompt_text = "\n".join(message["content"] for message in messages) if chat_api else prompt
+    # the whole prompt is unique: counted directly, not through the cache of prompt pieces
+    prompt_tokens = None if get_position_only else \
+        (await count_tokens(await get_tokenizer(service_config), [prompt_text]))[0]
+
     payload = {
         "model": service_config.get("model"),
-        "prompt": prompt,
-        "stream": False,
-        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "stream": stream,
         "options": {
             "temperature": service_config.get("temperature", 1.0),
             "top_p": service_config.get("top_p", 0.95),
@@ -56,10 +170,15 @@ async def send_prompt_to_ollama(user_id: str, prompt: str, bot_state, use_transl
             "frequency_penalty": service_config.get("frequency_penalty", 0.0),
             "presence_penalty": service_config.get("presence_penalty", 0.0),
             "stop": service_config.get("stop", None),
-            "num_ctx": service_config.get("max_tokens", 7000),
+            # chosen after the queue: the sticky bucket may grow while the request waits
+            "num_ctx": None,
             "num_predict": service_config.get("num_predict", 2048),
         }
     }
+    if chat_api:
+        payload["messages"] = messages
+    else:
+        payload["prompt"] = prompt
 
     if bot_state.debug_mode and not get_position_only:
         print("\n" + "="*60)
@@ -78,21 +197,48 @@ async def send_prompt_to_ollama(user_id: str, prompt: str, bot_state, use_transl
                     ollama_waiting.remove(user_id)
             return "", my_position    
 
-        async with ollama_semaphore:
+        payload["keep_alive"] = await ollama_keep_alive.on_request(payload["model"], api_url, bot_state.debug_mode)
+
+        # Alternative answers for /retry, only in slots that are free right now
+        # (queued users and running alternates included), so they never queue themselves
+        n_candidates = service_config.get("n_candidates", 1) if alternates is not None else 1
+        free_slots = ollama_semaphore.limit - len(ollama_waiting) - len(ollama_background_tasks)
+        for _ in range(min(n_candidates - 1, free_slots)):
+            if not ollama_semaphore.try_acquire():
+                break
+            task = asyncio.create_task(_generate_alternate(
+                api_url, payload, service_config, prompt_tokens, alternates,
+                reverse_translate_func if use_translation else None, bot_state.debug_mode
+            ))
+            ollama_background_tasks.add(task)
+            task.add_done_callback(ollama_background_tasks.discard)
+
+        async with ollama_semaphore, (decoding or contextlib.nullcontext()), ollama_keep_alive.in_flight(payload["model"], api_url):
+            payload["options"]["num_ctx"] = _pick_num_ctx(service_config, api_url, prompt_tokens)
+            if bot_state.debug_mode:
+                print(f"📐 num_ctx для {payload['model']}: {payload['options']['num_ctx']}")
             async with httpx.AsyncClient(timeout=service_config.get("timeout", 90)) as client:
-                response = await client.post(
-                    api_url,
-                    json=payload,
-                )
-                response.raise_for_status()
-                data = response.json()
-                result = data.get("response", "").strip()
+                stats = {}
+                if stream:
+                    result = await _stream_ollama_response(client, api_url, payload, stream_translator.feed, stats)
+                else:
+                    result = await _post_ollama(client, api_url, payload, stats)
+
+                # our token count against the model tokenizer
+                tokenizer_drift.report(payload["model"], prompt_tokens, stats.get("prompt_eval_count"),
+                                       len(prompt_text), bot_state.debug_mode)
 
                 if bot_state.debug_mode:
                     print("📜 Ответ Ollama:\n" + result)
                     print("="*60)
 
-                if use_translation and reverse_translate_func:
+                if stream:
+                    result = await stream_translator.finish()
+                    if bot_state.debug_mode:
+                        print("🈯 Перевод:\n" + result)
+                        print("="*60)
+
+                elif use_translation and reverse_translate_func:
                     result = reverse_translate_func(result)
                     if bot_state.debug_mode:
                         print("🈯 Перевод:\n" + result)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# ollama_keep_alive.py
+# This file is part of the BotAnya Telegram Bot project.
+# Adaptive keep_alive for Ollama models, driven by the request rate of each model.
+
+import time
+import asyncio
+import contextlib
+from collections import deque
+import httpx
+from bot_state import bot_state
+from config import (OLLAMA_KEEP_ALIVE, OLLAMA_KEEP_ALIVE_MIN, OLLAMA_RATE_WINDOW,
+                    OLLAMA_HOT_REQUESTS, OLLAMA_UNLOAD_IDLE)
+
+# keep_alive value that keeps the model loaded until it is unloaded explicitly
+KEEP_ALIVE_PINNED = -1
+
+
+
+# Ollama server of an API url: models of /api/generate and /api/chat on one host are the same
+def ollama_host(url: str) -> str:
+    return url.split("/api/", 1)[0].rstrip("/")
+
+
+
+class _ModelState:
+    __slots__ = ("host", "requests", "keep_alive", "last_used", "in_flight", "loaded")
+
+    def __init__(self, host: str):
+        self.host = host
+        self.requests = deque()   # monotonic times of requests inside the rate window
+        self.keep_alive = OLLAMA_KEEP_ALIVE
+        self.last_used = 0.0
+        self.in_flight = 0
+        self.loaded = False
+
+
+
+class OllamaKeepAlive:
+    """
+    Chooses keep_alive per request from the recent request rate of the model:
+    - at least OLLAMA_HOT_REQUESTS requests in OLLAMA_RATE_WINDOW — the model is pinned (-1);
+    - otherwise twice the average gap between requests, within [OLLAMA_KEEP_ALIVE_MIN, OLLAMA_KEEP_ALIVE].
+    Models are tracked per Ollama host. When a request for one model arrives, other loaded models
+    of the same host idle for OLLAMA_UNLOAD_IDLE seconds are unloaded with keep_alive 0 in the background (pinned models are released this way too).
+    In supervisor mode every worker process sees only the requests of its users: the hot threshold
+    is divided by the number of workers, and models are not unloaded explicitly, since another
+    worker may be using them (Ollama still unloads them after their keep_alive).
+    """
+
+    def __init__(self):
+        self._models = {}   # (host, model) -> _ModelState
+        self._unload_tasks = set()
+
+
+    def _state(self, model: str, url: str) -> _ModelState:
+        key = (ollama_host(url), model)
+        state = self._models.get(key)
+        if state is None:
+            state = self._models[key] = _ModelState(key[0])
+        return state
+
+
+    def _compute_keep_alive(self, state: _ModelState) -> int:
+        requests = state.requests
+        if len(requests) >= max(1, OLLAMA_HOT_REQUESTS // bot_state.workers):
+            return KEEP_ALIVE_PINNED
+        if len(requests) < 2:
+            return OLLAMA_KEEP_ALIVE_MIN
+        average_gap = (requests[-1] - requests[0]) / (len(requests) - 1)
+        return int(min(max(2 * average_gap, OLLAMA_KEEP_ALIVE_MIN), OLLAMA_KEEP_ALIVE))
+
+
+    # Model is still in Ollama memory (as far as the bot knows)
+    def is_loaded(self, model: str, url: str) -> bool:
+        state = self._models.get((ollama_host(url), model))
+        if not state or not state.loaded:
+            return False
+        if state.in_flight or state.keep_alive == KEEP_ALIVE_PINNED:
+            return True
+        return time.monotonic() - state.last_used < state.keep_alive
+
+
+    # Registering a queued request; returns keep_alive for its payload
+    async def on_request(self, model: str, url: str, debug: bool = False) -> int:
+        now = time.monotonic()
+        state = self._state(model, url)
+        state.requests.append(now)
+        while state.requests and now - state.requests[0] > OLLAMA_RATE_WINDOW:
+            state.requests.popleft()
+        state.keep_alive = self._compute_keep_alive(state)
+
+        if bot_state.workers == 1:
+            self._unload_idle(state, now, debug)
+
+        if debug:
+            print(f"🧊 keep_alive для {model}: {state.keep_alive} "
+                  f"({len(state.requests)} запросов за {OLLAMA_RATE_WINDOW // 60} мин)")
+        return state.keep_alive
+
+
+    # Unloading other models of the host idle for OLLAMA_UNLOAD_IDLE seconds; the request doesn't wait for it
+    def _unload_idle(self, state: _ModelState, now: float, debug: bool):
+        for (host, other), other_state in list(self._models.items()):
+            if other_state is state or host != state.host or not other_state.loaded or other_state.in_flight:
+                continue
+            # the last request may still be waiting in the queue
+            last_activity = max(other_state.last_used, other_state.requests[-1] if other_state.requests else 0.0)
+            if now - last_activity >= OLLAMA_UNLOAD_IDLE:
+                other_state.loaded = False
+                task = asyncio.create_task(self._unload(other, other_state, debug))
+                self._unload_tasks.add(task)
+                task.add_done_callback(self._unload_tasks.discard)
+
+
+    # Marks the model as busy while the request is processed
+    @contextlib.asynccontextmanager
+    async def in_flight(self, model: str, url: str):
+        state = self._models.get((ollama_host(url), model))
+        if state is None:
+            yield
+            return
+        state.in_flight += 1
+        state.loaded = True
+        try:
+            yield
+        finally:
+            state.in_flight -= 1
+            state.last_used = time.monotonic()
+
+
+    async def _unload(self, model: str, state: _ModelState, debug: bool):
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                response = await client.post(f"{state.host}/api/generate", json={"model": model, "keep_alive": 0})
+                response.raise_for_status()
+            if debug:
+                print(f"🧊 Модель {model} выгружена из памяти Ollama")
+        except Exception as e:
+            print(f"⚠️ Не удалось выгрузить модель {model}: {e}")
+
+
+
+# OllamaKeepAlive instance
+ollama_keep_alive = OllamaKeepAlive()
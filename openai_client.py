@@ -6,17 +6,25 @@
 # This file is part of the BotAnya Telegram Bot project.
 
 import json
+import contextlib
 import httpx
 import asyncio
 
+from utils import translate_messages, add_alternates
+from sse_stream import stream_sse_choices
+from resizable_semaphore import ResizableSemaphore
 from config import OPENAI_SEMAPHORE
 
-openai_semaphore = asyncio.Semaphore(OPENAI_SEMAPHORE)
+openai_semaphore = ResizableSemaphore(OPENAI_SEMAPHORE)
 openai_semaphore_lock = asyncio.Lock()
 openai_waiting = []
 
+
+
 async def send_prompt_to_openai(user_id: str, prompt: str, bot_state, use_translation: bool = False,
-                                translate_func=None, reverse_translate_func=None, get_position_only: bool = False) -> str:
+                                translate_func=None, reverse_translate_func=None, get_position_only: bool = False,
+                                stream_translator=None, decoding=None, messages=None, alternates=None,
+                                service_key=None) -> str:
     """
     Sends a prompt to the OpenAI API and returns the model's response.
 
@@ -27,32 +35,48 @@ async def send_prompt_to_openai(user_id: str, prompt: str, bot_state, use_transl
     :param translate_func: Function to translate the prompt to English.
     :param reverse_translate_func: Function to translate the response back to the original language.
     :param get_position_only: If True, returns only the position in the queue.
+    :param stream_translator: StreamingTranslator; if set together with use_translation, the response is streamed
+                              and translated sentence by sentence instead of reverse_translate_func.
+    :param decoding: Async context manager entered while the request is actually processed (after the queue),
+                     used to show the typing indicator.
+    :param messages: Chat messages ({"role", "content"}) sent instead of prompt as a single user message.
+    :param alternates: List filled with additional completions when the service has "n_candidates" > 1.
+    :param service_key: Service to use instead of the one selected by the user (background jobs).
     :return: A string with the text response from the OpenAI model, and the queue position (if a semaphore is used).
     """
     
     # Getting user service configuration
-    service_config = bot_state.get_user_service_config(user_id)
+    service_config = bot_state.get_user_service_config(user_id, service_key)
     if not service_config or service_config.get("type") != "openai":
         if bot_state.debug_mode:
             print("⚠️ OpenAI не выбран или отсутствует конфигурация.")
         return "", None
     
         # Getting user service key and auth key
-    service_key = bot_state.get_user_role(user_id).get("service", bot_state.config.get("default_service"))
+    service_key = service_key or bot_state.get_user_role(user_id).get("service", bot_state.config.get("default_service"))
     auth_key = bot_state.credentials.get("services", {}).get(service_key, {}).get("auth_key")
     api_url = service_config.get("url", "https://api.openai.com/v1/chat/completions")
 
+    if not messages:
+        messages = [{"role": "user", "content": prompt}]
+
     # Translate prompt if use_translation is True
-    if use_translation and translate_func:
-        prompt = translate_func(prompt)
+    if use_translation and translate_func and not get_position_only:
+        messages = translate_messages(messages, translate_func)
+
+    stream = bool(use_translation and stream_translator)
+    n_candidates = service_config.get("n_candidates", 1) if alternates is not None else 1
 
     payload = {
         "model": service_config.get("model", "gpt-4o-mini"),
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "max_tokens": service_config.get("num_predict", 2048),
         "temperature": service_config.get("temperature", 0.9),
-        "top_p": service_config.get("top_p", 0.95)
+        "top_p": service_config.get("top_p", 0.95),
+        "stream": stream
     }
+    if n_candidates > 1:
+        payload["n"] = n_candidates
 
     if bot_state.debug_mode and not get_position_only:
         print("\n" + "="*60)
@@ -77,30 +101,48 @@ async def send_prompt_to_openai(user_id: str, prompt: str, bot_state, use_transl
                     openai_waiting.remove(user_id)
             return "", my_position
 
-        async with openai_semaphore:
+        async with openai_semaphore, (decoding or contextlib.nullcontext()):
             async with httpx.AsyncClient(timeout=service_config.get("timeout", 90)) as client:
-                response = await client.post(
-                    api_url,
-                    headers=headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                data = response.json()
-
-                result = data["choices"][0]["message"]["content"].strip()
+                if stream:
+                    result, others = await stream_sse_choices(client, api_url, headers, payload,
+                                                              stream_translator.feed)
+                else:
+                    response = await client.post(
+                        api_url,
+                        headers=headers,
+                        json=payload
+                    )
+                    response.raise_for_status()
+                    data = response.json()
+
+                    choices = data["choices"]
+                    result = choices[0]["message"]["content"].strip()
+                    others = [choice["message"]["content"] for choice in choices[1:]]
                 
                 if bot_state.debug_mode:
                     print("📜 Ответ OpenAI:\n" + result)
                     print("=" * 60)
 
+                # Translate streamed response sentence by sentence
+                if stream:
+                    result = await stream_translator.finish()
+                    if bot_state.debug_mode:
+                        print("🈯 Перевод:")
+                        print(result)
+                        print("=" * 60)
+
                 # Translate response if use_translation is True
-                if use_translation and reverse_translate_func:
+                elif use_translation and reverse_translate_func:
                     result = reverse_translate_func(result)
                     if bot_state.debug_mode:
                         print("🈯 Перевод:")
                         print(result)
                         print("=" * 60)
 
+                if others:
+                    add_alternates(alternates, others,
+                                   reverse_translate_func if use_translation else None)
+
             async with openai_semaphore_lock:
                 if user_id in openai_waiting:
                     openai_waiting.remove(user_id)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# rate_limiter.py
+# This file is part of the BotAnya Telegram Bot project.
+# Outbound Telegram rate limiter: every Bot API call goes through one priority queue
+# with a global token bucket and per-chat token buckets. RetryAfter is honored.
+
+import asyncio
+import itertools
+from telegram.ext import BaseRateLimiter
+from telegram.error import RetryAfter
+from config import (TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST,
+                    TELEGRAM_GROUP_RATE, TELEGRAM_MAX_RETRIES)
+
+# Priorities (lower value is sent first)
+PRIORITY_REPLY = 0    # new messages and edits with the answer
+PRIORITY_NORMAL = 1   # everything else
+PRIORITY_ACTION = 2   # typing actions
+
+ENDPOINT_PRIORITIES = {
+    "sendMessage": PRIORITY_REPLY,
+    "editMessageText": PRIORITY_REPLY,
+    "answerCallbackQuery": PRIORITY_REPLY,
+    "sendChatAction": PRIORITY_ACTION,
+}
+
+# Max number of idle chat buckets kept in memory
+CHAT_BUCKETS_LIMIT = 10000
+
+
+
+# Token bucket
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until one token is available
+    def delay(self, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+
+# RetryAfter.retry_after can be int or timedelta depending on library version
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    if hasattr(value, "total_seconds"):
+        value = value.total_seconds()
+    return float(value)
+
+
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Central outbound queue for Bot API requests.
+
+    Requests wait in a priority queue (replies before typing actions) until both the global
+    bucket and the bucket of their chat have a token. Typing actions for a chat that already
+    has one queued are dropped. On RetryAfter the chat (or the whole bot, for requests
+    without chat) is paused and the request is queued again.
+    A call can override its priority with rate_limit_args=<priority>.
+    """
+
+    def __init__(self,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST,
+                 group_rate: float = TELEGRAM_GROUP_RATE,
+                 max_retries: int = TELEGRAM_MAX_RETRIES):
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._max_retries = max_retries
+
+        self._global = None
+        self._chats = {}          # chat_id -> TokenBucket
+        self._paused_until = {}   # chat_id (None = whole bot) -> loop time
+        self._waiters = []        # [priority, seq, chat_id, future]
+        self._pending_actions = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+
+    async def initialize(self):
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self._global_rate, self._global_rate, loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for *_, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        priority = rate_limit_args if isinstance(rate_limit_args, int) \
+            else ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_NORMAL)
+        is_action = endpoint == "sendChatAction"
+
+        # Typing action is already queued for this chat
+        if is_action and chat_id in self._pending_actions:
+            return True
+
+        attempt = 0
+        while True:
+            if is_action:
+                self._pending_actions.add(chat_id)
+            try:
+                await self._acquire(chat_id, priority)
+            finally:
+                if is_action:
+                    self._pending_actions.discard(chat_id)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                self._pause(chat_id, delay)
+                print(f"⚠️ Telegram flood limit: пауза {delay:.0f} с для {chat_id or 'бота'} ({endpoint})")
+                # a late typing action is useless
+                if is_action:
+                    return True
+                attempt += 1
+                if attempt > self._max_retries:
+                    raise
+
+
+    # Waiting for a token in the priority queue
+    async def _acquire(self, chat_id, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append([priority, next(self._seq), chat_id, future])
+        self._wakeup.set()
+        await future
+
+
+    def _pause(self, chat_id, delay: float):
+        until = asyncio.get_running_loop().time() + delay
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0), until)
+        self._wakeup.set()
+
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Groups and channels have negative ids and a stricter limit
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            rate = self._group_rate if is_group else self._chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self._chat_burst, now)
+        return bucket
+
+
+    # Seconds until the request for chat_id may be sent (without the global bucket)
+    def _chat_delay(self, chat_id, now: float) -> float:
+        delay = max(self._paused_until.get(None, 0.0), self._paused_until.get(chat_id, 0.0)) - now
+        if chat_id is not None:
+            delay = max(delay, self._chat_bucket(chat_id, now).delay(now))
+        return max(delay, 0.0)
+
+
+    def _prune(self, now: float):
+        if len(self._chats) > CHAT_BUCKETS_LIMIT:
+            waiting = {chat_id for _, _, chat_id, _ in self._waiters}
+            for chat_id in [c for c, b in self._chats.items() if c not in waiting and b.is_full(now)]:
+                del self._chats[chat_id]
+        for chat_id in [c for c, until in self._paused_until.items() if until <= now]:
+            del self._paused_until[chat_id]
+
+
+    # Dispatcher: grants tokens in priority order
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            wait = None
+
+            self._waiters.sort(key=lambda w: (w[0], w[1]))
+            remaining = []
+            for waiter in self._waiters:
+                _, _, chat_id, future = waiter
+                if future.done():
+                    continue
+                delay = max(self._global.delay(now), self._chat_delay(chat_id, now))
+                if delay <= 0:
+                    self._global.take()
+                    if chat_id is not None:
+                        self._chats[chat_id].take()
+                    future.set_result(None)
+                    continue
+                remaining.append(waiter)
+                wait = delay if wait is None else min(wait, delay)
+            self._waiters = remaining
+
+            self._prune(now)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
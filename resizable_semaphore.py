@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# resizable_semaphore.py
+# This file is part of the BotAnya Telegram Bot project.
+# Semaphore whose number of slots can be changed while requests are running.
+
+import asyncio
+from collections import deque
+
+
+
+class ResizableSemaphore:
+    """
+    asyncio semaphore with a changeable limit; waiters are served in FIFO order.
+    Shrinking does not interrupt running holders: new acquirers wait until
+    the number of holders drops below the new limit.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+
+
+    def locked(self) -> bool:
+        return self.active >= self.limit
+
+
+    def resize(self, limit: int):
+        self.limit = limit
+        self._wake()
+
+
+    # Taking a slot without waiting; False if there is no free slot or someone is queued
+    def try_acquire(self) -> bool:
+        if self._waiters or self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+
+    async def acquire(self) -> bool:
+        if not self._waiters and self.active < self.limit:
+            self.active += 1
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was already handed over: pass it on
+                self.release()
+            elif future in self._waiters:
+                # _wake() drops cancelled futures itself, they may be gone already
+                self._waiters.remove(future)
+            raise
+        return True
+
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+
+    def _wake(self):
+        while self._waiters and self.active < self.limit:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(True)
+
+
+    async def __aenter__(self):
+        await self.acquire()
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# service_clients.py
+# This file is part of the BotAnya Telegram Bot project.
+# Model service clients by service type, imported on first use.
+
+import importlib
+from bot_state import bot_state
+from config import OLLAMA_SEMAPHORE, GIGACHAT_SEMAPHORE, OPENAI_SEMAPHORE
+
+# service type -> (client module, send function, waiting list, semaphore)
+SERVICE_CLIENT_MODULES = {
+    "ollama": ("ollama_client", "send_prompt_to_ollama", "ollama_waiting", "ollama_semaphore"),
+    "gigachat": ("gigachat_client", "send_prompt_to_gigachat", "gigachat_waiting", "gigachat_semaphore"),
+    "openai": ("openai_client", "send_prompt_to_openai", "openai_waiting", "openai_semaphore"),
+}
+
+# Max concurrent requests of each service type, unless set in "concurrency" of config.json
+SERVICE_CONCURRENCY = {
+    "ollama": OLLAMA_SEMAPHORE,
+    "gigachat": GIGACHAT_SEMAPHORE,
+    "openai": OPENAI_SEMAPHORE,
+}
+
+# service type -> (send function, waiting list, semaphore)
+_clients = {}
+
+
+
+# Client of the service type: (send function, waiting list, semaphore), None for unknown types
+def get_service_client(service_type: str):
+    client = _clients.get(service_type)
+    if client is None and service_type in SERVICE_CLIENT_MODULES:
+        module_name, send_name, waiting_name, semaphore_name = SERVICE_CLIENT_MODULES[service_type]
+        module = importlib.import_module(module_name)
+        client = _clients[service_type] = (getattr(module, send_name), getattr(module, waiting_name),
+                                           getattr(module, semaphore_name))
+        client[2].resize(service_concurrency(service_type))
+    return client
+
+
+
+# In supervisor mode every worker process gets its share of the limit
+# (validate_config makes sure each limit is at least the number of workers)
+def service_concurrency(service_type: str) -> int:
+    limit = bot_state.config.get("concurrency", {}).get(service_type, SERVICE_CONCURRENCY[service_type])
+    return max(1, limit // bot_state.workers)
+
+
+
+# Resizing semaphores of the imported clients after a config reload (running requests keep their slots)
+def apply_concurrency():
+    for service_type, (_, _, semaphore) in _clients.items():
+        semaphore.resize(service_concurrency(service_type))
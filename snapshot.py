@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# snapshot.py
+# This file is part of the BotAnya Telegram Bot project.
+# Compact snapshot of roles and history: length-prefixed records, msgpack (if installed) or compact JSON.
+# Records can be read lazily: values stay encoded until they are needed and are written back as is.
+#
+# Converter:  python snapshot.py to-snapshot | to-json
+# Benchmark:  python snapshot.py bench --users 10000
+
+import os
+import sys
+import json
+import mmap
+import time
+import base64
+import struct
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from config import HISTORY_FILE, ROLES_FILE, HISTORY_SNAPSHOT_FILE, ROLES_SNAPSHOT_FILE
+
+# File header: magic + codec byte ("m" — msgpack, "j" — JSON)
+SNAPSHOT_MAGIC = b"BASNAP1"
+_LENGTH = struct.Struct(">I")
+
+
+
+# Encoded value of a record, decoded on demand
+class SnapshotRecord:
+    __slots__ = ("codec", "raw")
+
+    def __init__(self, codec: bytes, raw: bytes):
+        self.codec = codec
+        self.raw = raw
+
+
+    def decode(self):
+        return _decoder(self.codec)(self.raw)
+
+
+
+def _json_default(default):
+    def encode(obj):
+        if isinstance(obj, bytes):
+            return base64.b64encode(obj).decode("ascii")
+        if default:
+            return default(obj)
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return encode
+
+
+
+def _encoder(codec: bytes, default):
+    if codec == b"m":
+        packer = msgpack.Packer(use_bin_type=True, default=default)
+        return packer.pack
+    encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_json_default(default)).encode
+    return lambda value: encode(value).encode("utf-8")
+
+
+
+def _decoder(codec: bytes):
+    if codec == b"m":
+        if msgpack is None:
+            raise RuntimeError("Снимок записан в формате msgpack: установите пакет msgpack")
+        return lambda raw: msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    return lambda raw: json.loads(bytes(raw).decode("utf-8"))
+
+
+
+# Writing (key, value) records; the file is replaced only after it is fully written
+def write_snapshot(path: str, items, default=None):
+    """
+    Each record is the UTF-8 key and the encoded value, both prefixed with their length
+    (4 bytes, big-endian). default converts objects the codec doesn't know (like json.dump default=);
+    bytes are stored as is by msgpack and as base64 strings by JSON.
+    SnapshotRecord values in the same codec are copied without decoding.
+    """
+    codec = b"m" if msgpack is not None else b"j"
+    encode = _encoder(codec, default)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + codec)
+        for key, value in items:
+            if isinstance(value, SnapshotRecord):
+                payload = value.raw if value.codec == codec else encode(value.decode())
+            else:
+                payload = encode(value)
+            key = str(key).encode("utf-8")
+            f.write(_LENGTH.pack(len(key)))
+            f.write(key)
+            f.write(_LENGTH.pack(len(payload)))
+            f.write(payload)
+    os.replace(tmp_path, path)
+
+
+
+# Reading (key, value) records one by one from the memory-mapped file
+def read_snapshot(path: str, lazy: bool = False):
+    """
+    With lazy=True values are returned as SnapshotRecord (a copy of the encoded bytes),
+    so loading costs no parsing at all.
+    """
+    header_size = len(SNAPSHOT_MAGIC) + 1
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= header_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"{path} не является снимком BotAnya")
+            codec = data[len(SNAPSHOT_MAGIC):header_size]
+            decode = _decoder(codec)
+            offset = header_size
+            while offset < len(data):
+                (length,) = _LENGTH.unpack_from(data, offset)
+                key = data[offset + _LENGTH.size:offset + _LENGTH.size + length].decode("utf-8")
+                offset += _LENGTH.size + length
+                (length,) = _LENGTH.unpack_from(data, offset)
+                raw = data[offset + _LENGTH.size:offset + _LENGTH.size + length]
+                offset += _LENGTH.size + length
+                yield key, SnapshotRecord(codec, raw) if lazy else decode(raw)
+
+
+
+# Converting history.json / user_roles.json to snapshots and back
+def convert(to_snapshot: bool):
+    for json_path, snapshot_path in ((HISTORY_FILE, HISTORY_SNAPSHOT_FILE), (ROLES_FILE, ROLES_SNAPSHOT_FILE)):
+        source = json_path if to_snapshot else snapshot_path
+        if not os.path.exists(source):
+            print(f"⏭️ {source} не найден")
+            continue
+        started = time.perf_counter()
+        if to_snapshot:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            write_snapshot(snapshot_path, data.items())
+            target = snapshot_path
+        else:
+            data = dict(read_snapshot(snapshot_path))
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, default=_json_default(None))
+            target = json_path
+        print(f"✅ {source} → {target}: {len(data)} записей, {time.perf_counter() - started:.2f} с")
+
+
+
+def _synthetic_history(users: int, turns: int) -> dict:
+    text = "Она оглянулась на тёмный коридор и тихо сказала, что дверь всё ещё открыта. " * 3
+    history = {}
+    for user in range(users):
+        history[str(100000 + user)] = {
+            "scenario.json": {
+                "history": [["user" if i % 2 == 0 else "char", "Аня", f"{i}. {text}", None, 1735689600 + i]
+                            for i in range(turns)],
+                "last_input": text,
+            }
+        }
+    return history
+
+
+
+# Child process of the benchmark: loads one file and prints seconds and peak RSS (KiB)
+def _bench_load(kind: str, path: str):
+    from turns import turn_from_json
+    started = time.perf_counter()
+    if kind == "json":
+        with open(path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+    elif kind == "snapshot":
+        history = dict(read_snapshot(path))
+    else:
+        # what the bot does: records of users are decoded when they write
+        history = dict(read_snapshot(path, lazy=True))
+    for scenarios in history.values():
+        if isinstance(scenarios, SnapshotRecord):
+            continue
+        for data in scenarios.values():
+            data["history"] = [turn_from_json(entry) for entry in data.get("history", [])]
+    elapsed = time.perf_counter() - started
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        peak_rss = 0
+    print(f"{elapsed} {peak_rss}")
+
+
+
+def bench(users: int, turns: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, "history.json")
+        snapshot_path = os.path.join(tmp_dir, "history.snap")
+        history = _synthetic_history(users, turns)
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False, indent=2)
+        write_snapshot(snapshot_path, history.items())
+        del history
+
+        codec = "msgpack" if msgpack is not None else "json-записи"
+        print(f"📊 {users} пользователей × {turns} ходов, снимок: {codec}")
+        for kind, path in (("json", json_path), ("snapshot", snapshot_path), ("lazy", snapshot_path)):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "_bench-load", kind, path],
+                                    capture_output=True, text=True, check=True).stdout.split()
+            elapsed, peak_rss = float(output[0]), int(output[1])
+            print(f"   {kind:<9} {os.path.getsize(path) / 2**20:8.1f} МБ  загрузка {elapsed:6.2f} с  "
+                  f"пик RSS {peak_rss / 1024:7.1f} МБ")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BotAnya state snapshots: conversion and benchmark.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("to-snapshot", help="history.json and user_roles.json → snapshots")
+    commands.add_parser("to-json", help="snapshots → history.json and user_roles.json")
+    bench_parser = commands.add_parser("bench", help="compare loading of history.json and of a snapshot")
+    bench_parser.add_argument("--users", type=int, default=10000, help="Number of users")
+    bench_parser.add_argument("--turns", type=int, default=40, help="History turns per user")
+    load_parser = commands.add_parser("_bench-load")
+    load_parser.add_argument("kind")
+    load_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        bench(args.users, args.turns)
+    elif args.command == "_bench-load":
+        _bench_load(args.kind, args.path)
+    else:
+        convert(args.command == "to-snapshot")
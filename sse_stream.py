@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# sse_stream.py
+# This file is part of the BotAnya Telegram Bot project.
+# Reading streamed chat completions (server-sent events) of OpenAI-compatible APIs and GigaChat.
+
+import json
+
+
+
+# Reading streamed SSE response with one or several choices
+async def stream_sse_choices(client, url: str, headers: dict, payload: dict, on_delta):
+    """
+    Only the first choice is passed to on_delta; returns (first, [other choices]) when payload has n > 1.
+    """
+    parts = {}   # choice index -> text parts
+    async with client.stream("POST", url, headers=headers, json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            for choice in chunk.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content") or ""
+                if not delta:
+                    continue
+                index = choice.get("index", 0)
+                parts.setdefault(index, []).append(delta)
+                if index == 0:
+                    await on_delta(delta)
+    first = "".join(parts.pop(0, [])).strip()
+    return first, ["".join(parts[index]).strip() for index in sorted(parts)]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# startup_profiler.py
+# This file is part of the BotAnya Telegram Bot project.
+# Durations of the startup phases (BotAnya.py --profile-startup).
+
+import time
+
+
+
+class StartupProfiler:
+    """
+    Durations of the startup phases, printed with --profile-startup.
+    Each mark() closes the phase that started at the previous mark.
+    """
+
+    def __init__(self):
+        self._last = time.perf_counter()
+        self._phases = []   # (name, seconds)
+
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self._phases.append((name, now - self._last))
+        self._last = now
+
+
+    def report(self):
+        print("⏱️ Время запуска:")
+        for name, seconds in self._phases:
+            print(f"   {name:<24} {seconds * 1000:8.1f} мс")
+        print(f"   {'всего':<24} {sum(seconds for _, seconds in self._phases) * 1000:8.1f} мс")
+
+
+
+# StartupProfiler instance (the clock starts on import)
+startup_profiler = StartupProfiler()
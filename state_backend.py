@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# state_backend.py
+# This file is part of the BotAnya Telegram Bot project.
+# Storage of user roles, histories and world info: JSON/snapshot files or SQLite.
+
+import os
+import json
+import time
+import base64
+import sqlite3
+from config import ROLES_FILE, HISTORY_FILE, ROLES_SNAPSHOT_FILE, HISTORY_SNAPSHOT_FILE, STATE_DB_FILE
+from turns import PackedHistory, turn_to_json
+from snapshot import SnapshotRecord, read_snapshot, write_snapshot
+
+
+
+# json.dump default= hook for history file
+def _history_to_json(obj):
+    if isinstance(obj, PackedHistory):
+        return obj.to_json()
+    # records loaded from a snapshot (after switching state_format back to json)
+    if isinstance(obj, SnapshotRecord):
+        return obj.decode()
+    if isinstance(obj, bytes):
+        return base64.b64encode(obj).decode("ascii")
+    return turn_to_json(obj)
+
+
+
+# default= hook for history snapshot (packed histories are stored as bytes)
+def _history_to_snapshot(obj):
+    if isinstance(obj, PackedHistory):
+        return {"zlib": obj.blob}
+    return turn_to_json(obj)
+
+
+
+class StateBackend:
+    """
+    Interface of the state storage used by BotState.
+    Loaded histories are raw records: {user_id: {scenario_file: record}}, where record is
+    {"history": [turn entries], ...} or {"zlib": packed record}; BotState converts them to Turn objects.
+    Saving gets the in-memory dicts and the keys changed since the last save
+    (user ids for roles and world info, (user_id, scenario_file) for histories).
+    """
+
+    # True: histories are loaded per user with load_user_histories() instead of all at start
+    lazy = False
+
+    def load_roles(self) -> dict:
+        raise NotImplementedError
+
+    def save_roles(self, roles: dict, dirty: set):
+        raise NotImplementedError
+
+    def load_world_info(self) -> dict:
+        raise NotImplementedError
+
+    def save_world_info(self, world_info: dict, dirty: set):
+        raise NotImplementedError
+
+    def load_histories(self) -> dict:
+        raise NotImplementedError
+
+    def load_user_histories(self, user_id: str) -> dict:
+        raise NotImplementedError
+
+    def save_histories(self, histories: dict, dirty: set):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+
+class FileStateBackend(StateBackend):
+    """
+    The whole state in user_roles.json and history.json (or in snapshots, see snapshot.py).
+    Every save rewrites the file, so dirty keys are not used; world info is not saved.
+    """
+
+    def __init__(self, use_snapshot: bool = False):
+        self._use_snapshot = use_snapshot
+
+
+    def load_roles(self) -> dict:
+        # without a snapshot yet, the JSON file is read (it is converted on the next save)
+        if self._use_snapshot and os.path.exists(ROLES_SNAPSHOT_FILE):
+            return dict(read_snapshot(ROLES_SNAPSHOT_FILE))
+        if os.path.exists(ROLES_FILE):
+            with open(ROLES_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+
+    def save_roles(self, roles: dict, dirty: set):
+        if self._use_snapshot:
+            write_snapshot(ROLES_SNAPSHOT_FILE, roles.items())
+            return
+        with open(ROLES_FILE, "w", encoding="utf-8") as f:
+            json.dump(roles, f, ensure_ascii=False, indent=2)
+
+
+    def load_world_info(self) -> dict:
+        return {}
+
+
+    def save_world_info(self, world_info: dict, dirty: set):
+        pass
+
+
+    def load_histories(self) -> dict:
+        # users' records stay encoded until the user writes to the bot
+        if self._use_snapshot and os.path.exists(HISTORY_SNAPSHOT_FILE):
+            return dict(read_snapshot(HISTORY_SNAPSHOT_FILE, lazy=True))
+        if os.path.exists(HISTORY_FILE):
+            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+
+    def save_histories(self, histories: dict, dirty: set):
+        if self._use_snapshot:
+            write_snapshot(HISTORY_SNAPSHOT_FILE, histories.items(), default=_history_to_snapshot)
+            return
+        with open(HISTORY_FILE, "w", encoding="utf-8") as f:
+            json.dump(histories, f, ensure_ascii=False, indent=2, default=_history_to_json)
+
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    SQLite database in WAL mode: one row per user (roles, world info) and per user/scenario (histories).
+    Only changed rows are written, all of one save in a single transaction.
+    Histories are read when the user is active; packed histories are stored as zlib blobs.
+    On the first start the data of the file backend is imported.
+    """
+
+    lazy = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS roles (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS world_info (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS histories (
+            user_id TEXT NOT NULL,
+            scenario_file TEXT NOT NULL,
+            data BLOB NOT NULL,
+            packed INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (user_id, scenario_file)
+        );
+        CREATE INDEX IF NOT EXISTS histories_scenario ON histories (scenario_file);
+    """
+
+    def __init__(self, path: str = STATE_DB_FILE, use_snapshot: bool = False):
+        is_new = not os.path.exists(path)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        if is_new:
+            self._import_files(FileStateBackend(use_snapshot))
+
+
+    def _import_files(self, files: FileStateBackend):
+        roles = files.load_roles()
+        histories = files.load_histories()
+        if not roles and not histories:
+            return
+        for user_id, scenarios in histories.items():
+            if isinstance(scenarios, SnapshotRecord):
+                histories[user_id] = scenarios.decode()
+        self.save_roles(roles, set(roles))
+        self.save_histories(histories, {(user_id, scenario_file)
+                                        for user_id, scenarios in histories.items() for scenario_file in scenarios})
+        print(f"📥 В базу перенесены роли ({len(roles)}) и истории ({len(histories)}) из файлов.")
+
+
+    def _save_rows(self, table: str, values: dict, dirty: set):
+        with self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO {table} (user_id, data) VALUES (?, ?)",
+                [(user_id, json.dumps(values[user_id], ensure_ascii=False)) for user_id in dirty if user_id in values]
+            )
+            self._db.executemany(f"DELETE FROM {table} WHERE user_id = ?",
+                                 [(user_id,) for user_id in dirty if user_id not in values])
+
+
+    def load_roles(self) -> dict:
+        return {user_id: json.loads(data) for user_id, data in self._db.execute("SELECT user_id, data FROM roles")}
+
+
+    def save_roles(self, roles: dict, dirty: set):
+        self._save_rows("roles", roles, dirty)
+
+
+    def load_world_info(self) -> dict:
+        return {user_id: json.loads(data) for user_id, data in self._db.execute("SELECT user_id, data FROM world_info")}
+
+
+    def save_world_info(self, world_info: dict, dirty: set):
+        self._save_rows("world_info", world_info, dirty)
+
+
+    def load_histories(self) -> dict:
+        return {}
+
+
+    def load_user_histories(self, user_id: str) -> dict:
+        rows = self._db.execute("SELECT scenario_file, data, packed FROM histories WHERE user_id = ?", (user_id,))
+        return {scenario_file: {"zlib": data} if packed else json.loads(data)
+                for scenario_file, data, packed in rows}
+
+
+    def save_histories(self, histories: dict, dirty: set):
+        now = time.time()
+        rows = []
+        for user_id, scenario_file in dirty:
+            data = histories.get(user_id, {}).get(scenario_file)
+            if data is None:
+                continue
+            if isinstance(data, PackedHistory):
+                rows.append((user_id, scenario_file, data.blob, 1, now))
+            elif "zlib" in data:
+                rows.append((user_id, scenario_file, PackedHistory.from_json(data).blob, 1, now))
+            else:
+                rows.append((user_id, scenario_file,
+                             json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=turn_to_json), 0, now))
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO histories (user_id, scenario_file, data, packed, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+
+    def close(self):
+        self._db.close()
+
+
+
+# Backend for "state_backend" of config.json
+def create_state_backend(config: dict) -> StateBackend:
+    use_snapshot = config.get("state_format", "json") == "snapshot"
+    if config.get("state_backend", "file") == "sqlite":
+        return SQLiteStateBackend(STATE_DB_FILE, use_snapshot)
+    return FileStateBackend(use_snapshot)
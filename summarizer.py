@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# summarizer.py
+# This file is part of the BotAnya Telegram Bot project.
+# Background rolling summary of history turns trimmed out of the prompt.
+
+import asyncio
+from bot_state import bot_state, save_history
+from utils import build_summary_prompt, wrap_chatml_prompt
+from service_clients import get_service_client
+from config import SUMMARY_MIN_TURNS, SUMMARY_MAX_TURNS, SUMMARY_MIN_WORDS
+
+
+
+class Summarizer:
+    """
+    Keeps data["summary"] = {"text", "turns": N} — a summary of the first N turns of the history.
+    When at least SUMMARY_MIN_TURNS turns that are not in the prompt anymore are not summarized yet,
+    a background job folds them (up to SUMMARY_MAX_TURNS at once) into the summary.
+    Jobs use the "summary_service" of the service (or the service itself) and start
+    only when that service has a free slot, so users are not queued behind them.
+    """
+
+    def __init__(self):
+        self._running = set()   # (user_id, scenario_file) with an active job
+        self._tasks = set()
+
+
+    # Called after the history was trimmed for a prompt; dropped = turns not in the prompt
+    def schedule(self, user_id: str, scenario_file: str, service_config: dict, dropped: int):
+        if not service_config.get("summary_tokens", 0):
+            return
+        key = (str(user_id), scenario_file)
+        if key in self._running:
+            return
+
+        data = bot_state.get_user_history(user_id, scenario_file)
+        summarized = data.get("summary", {}).get("turns", 0)
+        if dropped - summarized < SUMMARY_MIN_TURNS:
+            return
+
+        # the job is sent as "summary:<user_id>", so the service key is always explicit
+        service_key = service_config.get("summary_service") or \
+            (bot_state.get_user_role(user_id) or {}).get("service", bot_state.config.get("default_service"))
+        summary_config = bot_state.get_user_service_config(user_id, service_key)
+        client = get_service_client((summary_config or {}).get("type"))
+        if not client:
+            return
+        send_func, waiting, semaphore = client
+        # no idle slot (users in the queue or slots held by /retry alternates): try again after the next message
+        if len(waiting) >= semaphore.limit or semaphore.locked():
+            return
+
+        self._running.add(key)
+        task = asyncio.create_task(self._run(key, data, summarized, min(dropped, summarized + SUMMARY_MAX_TURNS),
+                                             send_func, summary_config, service_key,
+                                             max(SUMMARY_MIN_WORDS, service_config["summary_tokens"] // 4)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+    async def _run(self, key, data: dict, start: int, end: int, send_func, summary_config: dict, service_key,
+                   max_words: int):
+        user_id, scenario_file = key
+        try:
+            history = data["history"]
+            last_turn = history[end - 1]
+            prompt = build_summary_prompt(data.get("summary", {}).get("text", ""), history[start:end], max_words)
+            if summary_config.get("chatml", False):
+                prompt = wrap_chatml_prompt(prompt)
+
+            text, position = await send_func(f"summary:{user_id}", prompt, bot_state, service_key=service_key)
+            if position is None or not text:
+                return
+
+            # the history could be reset or changed while the summary was generated
+            async with bot_state.get_user_lock(user_id):
+                current = bot_state.get_user_history(user_id, scenario_file)
+                if current is not data or len(data["history"]) < end or data["history"][end - 1] is not last_turn:
+                    return
+                text = text.strip()
+                bot_state.set_summary(user_id, scenario_file, {"text": text, "turns": end})
+                save_history()
+
+            if bot_state.debug_mode:
+                print(f"📝 Сводка для {user_id} обновлена: {end} ходов\n{text}")
+
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить сводку для {user_id}: {e}")
+        finally:
+            self._running.discard(key)
+
+
+
+# Summarizer instance
+summarizer = Summarizer()
@@ -7,25 +7,33 @@
 
 import json
 import os
+import io
+import gzip
 import asyncio
+import contextlib
 from telegram import Update, BotCommand, InlineKeyboardButton,Message,\
                          InlineKeyboardMarkup, CallbackQuery, ForceReply
 from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, \
                          ContextTypes, filters
-from telegram.error import BadRequest
-from telegram.constants import ChatAction
-from translate_utils import translate_prompt_to_english, translate_prompt_to_russian
+from telegram.error import BadRequest, RetryAfter
+from translate_utils import translate_prompt_to_english, translate_prompt_to_russian, StreamingTranslator
 
 from bot_state import bot_state, load_characters, save_roles, save_history
 from utils import safe_markdown_v2, smart_trim_history, build_chatml_prompt, \
                         build_plain_prompt, wrap_chatml_prompt, build_scene_prompt, \
-                        build_chatml_prompt_no_tail, build_plain_prompt_no_tail,  \
-                        build_system_prompt
-from ollama_client import send_prompt_to_ollama
-from gigachat_client import send_prompt_to_gigachat
-from openai_client import send_prompt_to_openai
+                        build_chatml_prompt_no_tail, build_plain_prompt_no_tail, build_chat_messages, \
+                        add_continue_cue, build_system_prompt, add_memories_to_prompt, add_summary_to_prompt, count_prompt_tokens, \
+                        count_history_tokens, prompt_cache
+from service_clients import get_service_client
+from config_reload import reload_config
+from typing_ticker import typing_ticker
+from input_coalescer import input_coalescer
+from memory_index import memory_store
+from summarizer import summarizer
+from tokenizers_registry import get_tokenizer
+from turns import Turn, ROLE_USER, ROLE_CHAR, ROLE_NARRATOR, NARRATOR_NAME
 
-from config import (SCENARIOS_DIR, MAX_LENGTH)
+from config import (SCENARIOS_DIR, MAX_LENGTH, STREAM_EDIT_INTERVAL, SCENE_HISTORY_TOKENS)
 
 
 
@@ -43,6 +51,7 @@ def register_handlers(app):
     app.add_handler(CommandHandler("reset", reset_command))
     app.add_handler(CommandHandler("lang", lang_command))
     app.add_handler(CommandHandler("help", help_command))
+    app.add_handler(CommandHandler("reload", reload_command))
     
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(MessageHandler(filters.REPLY & filters.TEXT, handle_force_reply))
@@ -52,6 +61,7 @@ def register_handlers(app):
     app.add_handler(CallbackQueryHandler(edit_callback_handler, pattern="^cb_edit$"))
     app.add_handler(CallbackQueryHandler(scenario_button, pattern="^scenario:"))
     app.add_handler(CallbackQueryHandler(service_button, pattern="^service:"))
+    app.add_handler(CallbackQueryHandler(history_button, pattern="^history:"))
     app.add_handler(CallbackQueryHandler(role_button))
 
 
@@ -79,15 +89,6 @@ def get_bot_commands():
 
 
 
-# Show typing animation
-async def _show_typing_animation(context, chat_id, stop_event):
-    while not stop_event.is_set():
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(6)  # Telegram API allows sending typing action every 5 seconds
-
-
-
-
 # Sending a message with MarkdownV2 formatting
 async def _safe_send_markdown(update, text: str, original_text: str = None, buttons: list = None) -> Message:
     """
@@ -129,6 +130,9 @@ async def _safe_send_markdown(update, text: str, original_text: str = None, butt
             original_text or text,
             reply_markup=reply_markup
         )
+    except RetryAfter:
+        # the rate limiter has already retried; resending as plain text would only add load
+        raise
     except Exception as e:
         # other errors 
         if bot_state.debug_mode:
@@ -141,6 +145,74 @@ async def _safe_send_markdown(update, text: str, original_text: str = None, butt
 
 
 
+# Editing a message with MarkdownV2 formatting
+async def _safe_edit_markdown(message: Message, text: str, original_text: str = None, buttons: list = None):
+    """
+        Safely edits a message with MarkdownV2. If formatting fails, retry without it.
+
+        :param message: Message to edit
+        :param text: text prepared for MarkdownV2
+        :param original_text: unformatted original, if Markdown breaks
+        :param buttons: list of buttons (list[list[InlineKeyboardButton]]) or None
+        :return: Message object, or None if the message can't be edited
+    """
+    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
+
+    if not text or not text.strip():
+        text = original_text = "⚠️ Думатель ничего не ответил ☹️. Попробуй ещё раз."
+
+    try:
+        # MarkdownV2
+        return await message.edit_text(text, parse_mode="MarkdownV2", reply_markup=reply_markup)
+    except BadRequest as e:
+        msg = str(e)
+        if "not modified" in msg:
+            return message
+        # fallback if it's a error with entities
+        if "can't parse entities" in msg or "Entity" in msg:
+            if bot_state.debug_mode:
+                print(f"⚠️ MarkdownV2 failed: {msg}\n→ редактируем plain text")
+            try:
+                return await message.edit_text(original_text or text, reply_markup=reply_markup)
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    return message
+                msg = str(e)
+        if bot_state.debug_mode:
+            print(f"⚠️ Не удалось отредактировать сообщение: {msg}")
+        return None
+    except RetryAfter:
+        raise
+    except Exception as e:
+        if bot_state.debug_mode:
+            print(f"⚠️ Неожиданная ошибка при редактировании: {e}")
+        return None
+
+
+
+
+# Cached alternative answers for /retry:
+# user_id -> (scenario_file, history version, speaker, char_emoji, list of answers)
+_alternates_cache = {}
+
+
+
+# Buttons under the bot answer
+def _answer_buttons() -> list:
+    return [[
+        InlineKeyboardButton("🔁 Повторить", callback_data="cb_retry"),
+        InlineKeyboardButton("⏭ Продолжить", callback_data="continue_reply"),
+        InlineKeyboardButton("✂️ Изменить", callback_data="cb_edit"),
+    ]]
+
+
+
+# Service takes the prompt as a list of chat messages
+def _uses_chat_messages(service_config: dict) -> bool:
+    return service_config.get("type") in ("openai", "gigachat") or service_config.get("chat_api", False)
+
+
+
 # Function to handle messages
 async def _generate_and_send(
     update: Update,
@@ -150,7 +222,9 @@ async def _generate_and_send(
     prompt: str,
     last_input: str,
     current_char: str,
-    char_emoji: str
+    char_emoji: str,
+    edit_message_id: int = None,
+    messages: list = None
 ):
     """
     Helper function to generate and send a message: 
@@ -160,22 +234,20 @@ async def _generate_and_send(
         - formats response,
         - puts it in history,
         - displays response with buttons.
+
+    If edit_message_id is set (regeneration), that bot message is edited into the placeholder
+    and then into the answer instead of deleting it and sending new messages.
+    messages is the same prompt as a chat message list, used by services with a chat API.
     """
     # service selection
     service_config = bot_state.get_user_service_config(user_id)
     service_type = service_config.get("type", "неизвестно")
     service_model = service_config.get("model", "неизвестно")
-    match service_type:
-        case "ollama":
-            send_func = send_prompt_to_ollama
-        case "gigachat":
-            send_func = send_prompt_to_gigachat
-        case "openai":
-            send_func = send_prompt_to_openai
-
-        case other:
-            await update.effective_message.reply_text(f"❌ Неизвестный тип сервиса: {other}")
-            return
+    client = get_service_client(service_type)
+    if client is None:
+        await update.effective_message.reply_text(f"❌ Неизвестный тип сервиса: {service_type}")
+        return
+    send_func = client[0]
 
     # queue position
     _, pos = await send_func(
@@ -183,61 +255,103 @@ async def _generate_and_send(
         use_translation=bot_state.get_user_role(user_id).get("use_translation", False),
         translate_func=translate_prompt_to_english,
         reverse_translate_func=translate_prompt_to_russian,
-        get_position_only=True
+        get_position_only=True,
+        messages=messages
     )
     if pos and pos > 1:
         await update.effective_message.reply_text(
             f"⏳ Ты в очереди: *{pos}*-й.", parse_mode="Markdown"
         )
 
-    # typing animation
-    thinking = await update.effective_message.reply_text("⌛️ Думаю…")
-    stop = asyncio.Event()
-    task = asyncio.create_task(_show_typing_animation(context, update.effective_chat.id, stop))
-
-    # response generation
+    # placeholder: the regenerated message itself or a new one
+    thinking = None
+    if edit_message_id:
+        try:
+            thinking = await context.bot.edit_message_text(
+                "⌛️ Думаю…", chat_id=update.effective_chat.id, message_id=edit_message_id
+            )
+        except BadRequest as e:
+            if bot_state.debug_mode:
+                print(f"⚠️ Не удалось переиспользовать сообщение {edit_message_id}: {e}")
+    if not isinstance(thinking, Message):
+        edit_message_id = None
+        thinking = await update.effective_message.reply_text("⌛️ Думаю…")
+
+    # streamed reverse translation: translated sentences are appended to the "thinking" message
+    use_translation = bot_state.get_user_role(user_id).get("use_translation", False)
+    stream_translator = None
+    if use_translation:
+        last_edit = 0.0
+
+        async def show_partial(text: str):
+            nonlocal last_edit
+            now = asyncio.get_running_loop().time()
+            if now - last_edit < STREAM_EDIT_INTERVAL:
+                return
+            last_edit = now
+            with contextlib.suppress(BadRequest):
+                await thinking.edit_text(f"{char_emoji}: {text} ⌛️"[:MAX_LENGTH])
+
+        stream_translator = StreamingTranslator("ru", on_update=show_partial)
+
+    # response generation (extra candidates are kept for /retry)
+    alternates = []
     try:
         reply, _ = await send_func(
             user_id, prompt, bot_state,
-            use_translation=bot_state.get_user_role(user_id).get("use_translation", False),
+            use_translation=use_translation,
             translate_func=translate_prompt_to_english,
-            reverse_translate_func=translate_prompt_to_russian
+            reverse_translate_func=translate_prompt_to_russian,
+            stream_translator=stream_translator,
+            # typing animation, only while the request is being decoded
+            decoding=typing_ticker.decoding(update.effective_chat.id),
+            messages=messages,
+            alternates=alternates
         )
     except Exception as e:
         reply = f"⚠️ Ошибка: {e}"
     finally:
-        stop.set()
-        await task
-    try:
-        await thinking.delete()
-    except Exception:
-        pass
+        if stream_translator:
+            stream_translator.cancel()
 
     # formatting response and buttons
     display = f"{char_emoji}: {reply}".strip()
     formatted = safe_markdown_v2(display)
-    buttons = [[
-        InlineKeyboardButton("🔁 Повторить", callback_data="cb_retry"),
-        InlineKeyboardButton("⏭ Продолжить", callback_data="continue_reply"),
-        InlineKeyboardButton("✂️ Изменить", callback_data="cb_edit"),
-    ]]
-    bot_msg = await _safe_send_markdown(update, formatted, display, buttons)
+    buttons = _answer_buttons()
+
+    # regeneration: the placeholder becomes the answer
+    bot_msg = None
+    try:
+        if edit_message_id:
+            bot_msg = await _safe_edit_markdown(thinking, formatted, display, buttons)
+        if bot_msg is None:
+            try:
+                await thinking.delete()
+            except Exception:
+                pass
+            bot_msg = await _safe_send_markdown(update, formatted, display, buttons)
+    except RetryAfter as e:
+        # the generated reply is still saved below: it is in /history and can be regenerated
+        print(f"⚠️ Ответ для {user_id} не отправлен: Telegram просит подождать {e.retry_after} с.")
 
     # saving history and logging
-    role_entry = bot_state.get_user_role(user_id)
-    use_translation = role_entry.get("use_translation", False)
     lang = "EN" if use_translation else "RU"
 
     lock = bot_state.get_user_lock(user_id)
     async with lock:
         data = bot_state.get_user_history(user_id, scenario_file)
-        data["history"].append(f"{current_char}: {reply}")
+        role = ROLE_NARRATOR if current_char == NARRATOR_NAME else ROLE_CHAR
+        data["history"].append(Turn.new(role, current_char, reply))
         bot_state.update_user_history(
             user_id, scenario_file, data["history"],
-            last_input=last_input, last_bot_id=bot_msg.message_id
+            last_input=last_input, last_bot_id=bot_msg.message_id if bot_msg else None
         )
         save_history()
 
+        if service_config.get("n_candidates", 1) > 1:
+            version = bot_state.get_history_version(user_id, scenario_file)
+            _alternates_cache[user_id] = (scenario_file, version, current_char, char_emoji, alternates)
+
         # Logging bot answer
         bot_state.append_to_archive_bot(
             user_id,
@@ -369,7 +483,7 @@ async def set_role(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # /scene handler
-async def scene_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def scene_command(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message_id: int = None):
     user_id = str(update.effective_user.id)
 
     # Get char and user info
@@ -383,18 +497,33 @@ async def scene_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_emoji = world.get("user_emoji", "👤")
     user_name = world.get("user_name", "Пользователь")
 
+    service_config = bot_state.get_user_service_config(user_id)
+    if service_config is None:
+        await update.effective_message.reply_text("⚠️ Ошибка: выбранный думатель не найден. Попробуй /service.")
+        return
+
+    # Recent history within the scene budget (and within the context left after the scene instructions)
     user_data = bot_state.get_user_history(user_id, scenario_file)
-    recent_history = user_data.get("history", [])[-5:]  # last 5 messages
+    tokenizer = await get_tokenizer(service_config)
+    scene_tokens = await count_prompt_tokens(tokenizer,
+                                             build_scene_prompt(world_prompt, char, user_emoji, user_name, user_role))
+    history_budget = min(service_config.get("scene_tokens", SCENE_HISTORY_TOKENS),
+                         service_config.get("max_tokens", 7000) - scene_tokens)
+    await count_history_tokens(user_data.get("history", []), tokenizer, history_budget)
+    recent_history, history_tokens = smart_trim_history(user_data.get("history", []), tokenizer,
+                                                        history_budget)
+    if bot_state.debug_mode:
+        print(f"\n📊 [Debug] Токенов в сцене: {scene_tokens} + {history_tokens} (история)\n")
 
     # Base prompt
     base_prompt = build_scene_prompt(world_prompt, char, user_emoji, user_name, user_role, recent_history)
-    service_config = bot_state.get_user_service_config(user_id)
     
     # Prompt format
     if service_config.get("chatml", False):
         prompt = wrap_chatml_prompt(base_prompt)
     else:
         prompt = base_prompt
+    messages = [{"role": "user", "content": base_prompt}] if _uses_chat_messages(service_config) else None
 
     await _generate_and_send(
         update, context,
@@ -402,8 +531,10 @@ async def scene_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         scenario_file=scenario_file,
         prompt=prompt,
         last_input="",  # last_input empty
-        current_char="Narrator",
-        char_emoji="📜"
+        current_char=NARRATOR_NAME,
+        char_emoji="📜",
+        edit_message_id=edit_message_id,
+        messages=messages
     )
 
 
@@ -452,6 +583,62 @@ async def whoami_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Replacing the last answer with a cached alternative (no request to the model)
+async def _serve_alternate(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: str,
+                           scenario_file: str, history: list, last_bot_id: int) -> bool:
+    """
+    Must be called under the user lock. Returns False if there is no valid alternative.
+    """
+    cached = _alternates_cache.get(user_id)
+    if not cached:
+        return False
+    cached_scenario, version, speaker, char_emoji, alternates = cached
+    if (cached_scenario != scenario_file or version != bot_state.get_history_version(user_id, scenario_file)
+            or not alternates or history[-1].speaker != speaker):
+        return False
+
+    reply = alternates.pop(0)
+    display = f"{char_emoji}: {reply}"
+    reply_markup = InlineKeyboardMarkup(_answer_buttons())
+    chat_id = update.effective_chat.id
+    try:
+        await context.bot.edit_message_text(safe_markdown_v2(display), chat_id=chat_id, message_id=last_bot_id,
+                                            parse_mode="MarkdownV2", reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            try:
+                await context.bot.edit_message_text(display, chat_id=chat_id, message_id=last_bot_id,
+                                                    reply_markup=reply_markup)
+            except BadRequest as e:
+                if bot_state.debug_mode:
+                    print(f"⚠️ Не удалось показать альтернативный ответ: {e}")
+                return False
+
+    last = history[-1]
+    history[-1] = Turn.new(last.role, last.speaker, reply)
+    bot_state.update_user_history(user_id, scenario_file, history)
+    save_history()
+    _alternates_cache[user_id] = (scenario_file, bot_state.get_history_version(user_id, scenario_file),
+                                  speaker, char_emoji, alternates)
+
+    # Logging bot answer
+    service_config = bot_state.get_user_service_config(user_id) or {}
+    use_translation = (bot_state.get_user_role(user_id) or {}).get("use_translation", False)
+    bot_state.append_to_archive_bot(
+        user_id,
+        service_config.get("type", "неизвестно"),
+        service_config.get("model", "неизвестно"),
+        "EN" if use_translation else "RU",
+        speaker,
+        reply
+    )
+
+    if bot_state.debug_mode:
+        print(f"🔁 Альтернативный ответ из кэша, осталось: {len(alternates)}")
+    return True
+
+
+
 # /retry handler
 async def retry_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -462,7 +649,6 @@ async def retry_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     name = char["name"]
-    user_name = world.get("user_name", "Пользователь")
 
     lock = bot_state.get_user_lock(user_id)
     do_continue = False
@@ -478,57 +664,54 @@ async def retry_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.effective_message.reply_text("⚠️ История пуста — нечего повторять.")
             return
 
+        prompt_cache.invalidate(user_id)
+
+        # Alternative answer generated together with the last one
+        if await _serve_alternate(update, context, user_id, scenario_file, history, last_bot_id):
+            return
+
         last = history[-1]
 
+        # The last bot message is not deleted: it is edited in place with the new answer
+
         # If was Narrator scene
-        if last.startswith("Narrator:"):
+        if last.role == ROLE_NARRATOR:
             history.pop()
             bot_state.update_user_history(user_id, scenario_file, history)
             save_history()
-            try:
-                await context.bot.delete_message(update.effective_chat.id, last_bot_id)
-            except:
-                pass
             do_scene = True
 
         # If there is no user message before the last bot message,
         # this means there was a call via "continue"
-        elif len(history) < 2 or not history[-2].startswith(f"{user_name}:"):
+        elif len(history) < 2 or history[-2].role != ROLE_USER:
             history.pop()  # delete the bot message
             bot_state.update_user_history(user_id, scenario_file, history)
             save_history()
-            try:
-                await context.bot.delete_message(update.effective_chat.id, last_bot_id)
-            except:
-                pass
             do_continue = True
 
         # if this is a normal flow of messages
-        elif last.startswith(f"{name}:"):
+        elif last.role == ROLE_CHAR and last.speaker == name:
             history.pop()  # delete the bot message
             if history:
                 history.pop()  # delete the user message
-            try:
-                await context.bot.delete_message(update.effective_chat.id, last_bot_id)
-            except:
-                pass
+            bot_state.update_user_history(user_id, scenario_file, history)
 
         else:
             await update.effective_message.reply_text("⚠️ Нельзя перегенерировать это сообщение.")
             return
 
     if do_continue:
-        return await continue_command(update, context)
+        return await continue_command(update, context, edit_message_id=last_bot_id)
     if do_scene:
-        return await scene_command(update, context)
-    return await handle_message(update, context, override_input=last_input)
+        return await scene_command(update, context, edit_message_id=last_bot_id)
+    return await handle_message(update, context, override_input=last_input, edit_message_id=last_bot_id)
 
 
 
 
 
 # /continue handler
-async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_message_id: int = None):
     user_id = str(update.effective_user.id)
 
     # Check if user has a character and world
@@ -545,8 +728,8 @@ async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return    
 
     # If was Narrator scene
-    if history[-1].startswith("Narrator:"):
-        return await scene_command(update, context)
+    if history[-1].role == ROLE_NARRATOR:
+        return await scene_command(update, context, edit_message_id=edit_message_id)
 
 
     service_config = bot_state.get_user_service_config(user_id)
@@ -561,22 +744,38 @@ async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
    
     base_prompt = build_system_prompt(world_prompt, char, user_emoji, user_name, user_role_description)
-    tokens_used = len(bot_state.encoding.encode(base_prompt))
+    tokenizer = await get_tokenizer(service_config)
+    tokens_used = await count_prompt_tokens(tokenizer, base_prompt)
     
     max_tokens = service_config.get("max_tokens", 7000)
-    trimmed_history, tokens_used = smart_trim_history(history, bot_state.encoding,
-                                                    max_tokens - tokens_used)
+    memory_tokens = service_config.get("memory_tokens", 0)
+    summary = user_data.get("summary") if service_config.get("summary_tokens", 0) else None
+    summary_tokens = await count_prompt_tokens(tokenizer, summary["text"]) if summary else 0
+    history_budget = max_tokens - tokens_used - memory_tokens - summary_tokens
+    await count_history_tokens(history, tokenizer, history_budget)
+    trimmed_history, tokens_used = smart_trim_history(history, tokenizer, history_budget)
+
+    # Summary of earlier events and old turns relevant to the end of the dialogue
+    memories = memory_store.recall(user_id, scenario_file, history, len(trimmed_history),
+                                   tokenizer, memory_tokens)
+    base_prompt = add_memories_to_prompt(add_summary_to_prompt(base_prompt, summary), memories)
+    summarizer.schedule(user_id, scenario_file, service_config, len(history) - len(trimmed_history))
     if bot_state.debug_mode:
         print(f"\n📊 [Debug] Токенов в prompt: {tokens_used} / {max_tokens}\n")
 
     # 3) Make full prompt
     if service_config.get("chatml", False):
         # ChatML-prompt
-        prompt = build_chatml_prompt_no_tail(base_prompt, trimmed_history, user_name, char["name"])
+        prompt = build_chatml_prompt_no_tail(base_prompt, trimmed_history, char["name"],
+                                             cache_key=(user_id, scenario_file))
 
     else:
         # Plain text prompt
-        prompt = build_plain_prompt_no_tail(base_prompt, trimmed_history)
+        prompt = build_plain_prompt_no_tail(base_prompt, trimmed_history, cache_key=(user_id, scenario_file))
+
+    # Message list for chat APIs, with an explicit request to continue the last reply
+    messages = add_continue_cue(build_chat_messages(base_prompt, trimmed_history, char["name"]), char["name"]) \
+        if _uses_chat_messages(service_config) else None
 
 
     # 4) Helper function to send the prompt and get the response
@@ -587,7 +786,9 @@ async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         prompt=prompt,
         last_input=user_data.get("last_input", ""),
         current_char=char["name"],
-        char_emoji=char.get("emoji", "🤖")
+        char_emoji=char.get("emoji", "🤖"),
+        edit_message_id=edit_message_id,
+        messages=messages
     )
     
 
@@ -615,6 +816,7 @@ async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         if bot_state.is_valid_last_exchange(user_id, scenario_file, name, user_name):
+            prompt_cache.invalidate(user_id)
             history_cut = user_data["history"][:-2]
             bot_state.update_user_history(user_id, scenario_file, history_cut, last_input=user_data["last_input"])
             save_history()
@@ -631,6 +833,83 @@ async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Emoji of scenario characters by name
+def _char_emoji_by_name(characters: dict) -> dict:
+    return {char_data["name"]: char_data.get("emoji", "🤖") for char_data in characters.values()}
+
+
+
+# History entry as shown to the user: "<emoji>: text"
+def _format_turn(turn: Turn, char_emoji: dict, user_emoji: str) -> str:
+    if turn.role == ROLE_NARRATOR:
+        return f"📜: {turn.text}"
+    if turn.role == ROLE_USER:
+        return f"{user_emoji}: {turn.text}"
+    emoji = char_emoji.get(turn.speaker)
+    return f"{emoji}: {turn.text}" if emoji else turn.line()
+
+
+
+
+# /history pages cache: user_id -> (scenario_file, history_version, pages)
+# every page is [raw text, MarkdownV2 text or None until shown]
+_history_pages_cache = {}
+
+
+
+# Splitting formatted history into pages
+def _get_history_pages(user_id: str, scenario_file: str) -> list:
+    version = bot_state.get_history_version(user_id, scenario_file)
+    cached = _history_pages_cache.get(user_id)
+    if cached and cached[0] == scenario_file and cached[1] == version:
+        return cached[2]
+
+    history = bot_state.get_user_history(user_id, scenario_file).get("history", [])
+
+    # Getting characters and emoji for the user
+    characters, world = load_characters(os.path.join(SCENARIOS_DIR, scenario_file))
+    char_emoji = _char_emoji_by_name(characters)
+    user_emoji = world.get("user_emoji", "🧑")
+
+    # Formatting history and splitting it into chunks
+    pages = []
+    current = ""
+    for turn in history:
+        formatted = _format_turn(turn, char_emoji, user_emoji)
+
+        if current and len(current) + len(formatted) + 1 > MAX_LENGTH:
+            pages.append([current, None])
+            current = ""
+        current += formatted + "\n"
+    if current:
+        pages.append([current, None])
+
+    _history_pages_cache[user_id] = (scenario_file, version, pages)
+    return pages
+
+
+
+def _history_buttons(page: int, total: int) -> list:
+    buttons = []
+    if total > 1:
+        buttons.append([
+            InlineKeyboardButton("⬅️", callback_data=f"history:{max(page - 1, 0)}"),
+            InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"history:{page}"),
+            InlineKeyboardButton("➡️", callback_data=f"history:{min(page + 1, total - 1)}"),
+        ])
+    buttons.append([InlineKeyboardButton("📥 Скачать файлом", callback_data="history:file")])
+    return buttons
+
+
+
+def _history_page_text(pages: list, page: int):
+    raw, formatted = pages[page]
+    if formatted is None:
+        formatted = pages[page][1] = safe_markdown_v2(raw)
+    return formatted, raw
+
+
+
 # /history handler
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -642,51 +921,57 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     scenario_file = role_entry["scenario"]
-    user_data = bot_state.get_user_history(user_id, scenario_file)
-    history = user_data.get("history", [])
+    pages = _get_history_pages(user_id, scenario_file)
 
-    if not history:
+    if not pages:
         await update.message.reply_text("📭 История пока пуста. Напиши что-нибудь!")
         return
 
-    # Getting characters and emoji for the user
-    characters, world = load_characters(os.path.join(SCENARIOS_DIR, scenario_file))
-    user_emoji = world.get("user_emoji", "🧑")
-    user_name = world.get("user_name", "Пользователь")
+    # The last page is the most recent one
+    page = len(pages) - 1
+    formatted, raw = _history_page_text(pages, page)
+    await _safe_send_markdown(update, formatted, raw, _history_buttons(page, len(pages)))
 
-    # Formatting history
-    formatted_lines = []
-    for line in history:
-        if line.startswith("Narrator:"):
-            text = line[len("Narrator:"):].strip()
-            formatted_lines.append(f"📜: {text}")
-        elif line.startswith(f"{user_name}:"):
-            text = line[len(f"{user_name}:"):].strip()
-            formatted_lines.append(f"{user_emoji}: {text}")
-        else:
-            # Checking if the line starts with a character name
-            for char_key, char_data in characters.items():
-                if line.startswith(f"{char_data['name']}:"):
-                    text = line[len(f"{char_data['name']}:"):].strip()
-                    formatted_lines.append(f"{char_data.get('emoji', '🤖')}: {text}")
-                    break
-            else:
-                formatted_lines.append(line)
-    
-    # Splitting into chunks if too long
-    chunks = []
-    current = ""
-    for line in formatted_lines:
-        if len(current) + len(line) + 1 > MAX_LENGTH:
-            chunks.append(current)
-            current = ""
-        current += line + "\n"
-    if current:
-        chunks.append(current)
 
-    for chunk in chunks:
-        formatted_chunk = safe_markdown_v2(chunk)
-        await _safe_send_markdown(update, formatted_chunk, chunk)
+
+# history pages and download buttons handler
+async def history_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query: CallbackQuery = update.callback_query
+    await query.answer()
+
+    user_id = str(query.from_user.id)
+    role_entry = bot_state.get_user_role(user_id)
+    if not role_entry or not role_entry.get("scenario"):
+        await query.edit_message_text("❗ Сначала выбери сценарий с помощью /scenario.")
+        return
+
+    scenario_file = role_entry["scenario"]
+    pages = _get_history_pages(user_id, scenario_file)
+    if not pages:
+        await query.edit_message_text("📭 История пока пуста. Напиши что-нибудь!")
+        return
+
+    action = query.data.split(":", 1)[1]
+
+    # Whole history as a compressed file, written page by page
+    if action == "file":
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as archive:
+            for raw, _ in pages:
+                archive.write(raw.encode("utf-8"))
+        buffer.seek(0)
+        name = os.path.splitext(scenario_file)[0]
+        await query.message.reply_document(document=buffer, filename=f"history_{name}.txt.gz")
+        return
+
+    # the query is already answered: a malformed button (an old or forged callback) is just ignored
+    try:
+        page = int(action)
+    except ValueError:
+        return
+    page = min(max(page, 0), len(pages) - 1)
+    formatted, raw = _history_page_text(pages, page)
+    await _safe_edit_markdown(query.message, formatted, raw, _history_buttons(page, len(pages)))
 
 
 
@@ -705,11 +990,8 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lock = bot_state.get_user_lock(user_id)
     async with lock:
 
-        bot_state.user_history.setdefault(user_id, {})[scenario_file] = {
-            "history": [],
-            "last_input": "",
-            "last_bot_id": None
-        }
+        bot_state.reset_user_history(user_id, scenario_file)
+        prompt_cache.invalidate(user_id)
 
     await update.message.reply_text(
         f"🔁 История очищена! Ты можешь начать диалог заново с {char["name"]}\n\n"
@@ -724,7 +1006,7 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             intro_scene = world.get("intro_scene", "")
             if intro_scene:
                 user_data = bot_state.get_user_history(user_id, scenario_file)
-                narrator_entry = f"Narrator: {intro_scene}"
+                narrator_entry = Turn.new(ROLE_NARRATOR, NARRATOR_NAME, intro_scene)
                 user_data["history"].append(narrator_entry)
                 bot_state.update_user_history(user_id, scenario_file, user_data["history"])
                 save_history()
@@ -775,6 +1057,23 @@ async def lang_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# /reload handler (admins from "admins" in config.json only, not shown in the menu)
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if user_id not in {str(admin) for admin in bot_state.config.get("admins", [])}:
+        await update.message.reply_text("⛔ Эта команда только для администраторов.")
+        return
+
+    errors = reload_config(notify=True)
+    if errors:
+        await update.message.reply_text("⚠️ Конфигурация не применена:\n" + "\n".join(errors))
+    else:
+        await update.message.reply_text("🔄 Конфигурация перезагружена. Текущие запросы доработают со старыми настройками.")
+
+
+
+
+
 # /help handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -841,7 +1140,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Handle incoming messages
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, override_input=None):
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, override_input=None,
+                         edit_message_id: int = None):
+    # New messages sent in a quick burst are merged into one turn (override_input bypasses this)
+    if override_input is None:
+        async def generate(text: str):
+            await handle_message(update, context, override_input=text)
+
+        input_coalescer.submit(str(update.effective_user.id), update.effective_message.text, generate,
+                               create_task=context.application.create_task)
+        return
+
     user_input = override_input or update.effective_message.text
 
     user_obj = update.effective_user
@@ -886,7 +1195,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
         await update.effective_message.reply_text("⚠️ Ошибка: выбранный думатель не найден. Попробуй /service.")
         return
     
-    tokens_used = len(bot_state.encoding.encode(base_prompt))
+    tokenizer = await get_tokenizer(service_config)
+    tokens_used = await count_prompt_tokens(tokenizer, base_prompt)
 
     # Getting user history and trimming it if necessary
     async with lock:
@@ -895,23 +1205,37 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
         history = user_data["history"]
         
         max_tokens = service_config.get("max_tokens", 7000)
+        memory_tokens = service_config.get("memory_tokens", 0)
+        summary = user_data.get("summary") if service_config.get("summary_tokens", 0) else None
+        summary_tokens = await count_prompt_tokens(tokenizer, summary["text"]) if summary else 0
 
-        user_message = f"{user_name}: {user_input}"
+        user_message = Turn.new(ROLE_USER, user_name, user_input.strip())
         history.append(user_message)
         
-        trimmed_history, tokens_used = smart_trim_history(history, bot_state.encoding,
-                                                        max_tokens - tokens_used)
+        history_budget = max_tokens - tokens_used - memory_tokens - summary_tokens
+        await count_history_tokens(history, tokenizer, history_budget)
+        trimmed_history, tokens_used = smart_trim_history(history, tokenizer, history_budget)
+
+        # Summary of earlier events and old turns relevant to the new message
+        memories = memory_store.recall(user_id, scenario_file, history, len(trimmed_history),
+                                       tokenizer, memory_tokens)
+        base_prompt = add_memories_to_prompt(add_summary_to_prompt(base_prompt, summary), memories)
+        summarizer.schedule(user_id, scenario_file, service_config, len(history) - len(trimmed_history))
 
         bot_state.update_user_history(user_id, scenario_file, history, last_input=user_input)
         save_history()
 
     if service_config.get("chatml", False):
         # ChatML-prompt
-        prompt = build_chatml_prompt(base_prompt, trimmed_history, user_name, char["name"])
+        prompt = build_chatml_prompt(base_prompt, trimmed_history, char["name"], cache_key=(user_id, scenario_file))
 
     else:
         # Plain text prompt
-        prompt = build_plain_prompt(base_prompt, trimmed_history, char['name'])
+        prompt = build_plain_prompt(base_prompt, trimmed_history, char['name'], cache_key=(user_id, scenario_file))
+
+    # Message list for chat APIs
+    messages = build_chat_messages(base_prompt, trimmed_history, char["name"]) \
+        if _uses_chat_messages(service_config) else None
 
     if bot_state.debug_mode:
         print(f"\n📊 [Debug] Токенов в prompt: {tokens_used} / {max_tokens}\n")
@@ -923,7 +1247,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, ove
         prompt=prompt,
         last_input=user_input,
         current_char=char["name"],
-        char_emoji=char.get("emoji", "🤖")
+        char_emoji=char.get("emoji", "🤖"),
+        edit_message_id=edit_message_id,
+        messages=messages
     )
 
     
@@ -957,13 +1283,7 @@ async def scenario_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lock = bot_state.get_user_lock(user_id)
         async with lock:
 
-            user_histories = bot_state.user_history.setdefault(user_id, {})
-            if selected_file not in user_histories:
-                user_histories[selected_file] = {
-                    "history": [],
-                    "last_input": "",
-                    "last_bot_id": None
-                }
+            bot_state.get_user_history(user_id, selected_file)
 
             # Getting translation flag from the previous role
             prev_role = bot_state.get_user_role(user_id)
@@ -972,6 +1292,7 @@ async def scenario_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Deleting user role
             bot_state.clear_user_role(user_id)
             bot_state.set_user_role(user_id, role=None, scenario_file=selected_file, use_translation=use_translation)
+            bot_state.pack_inactive_histories(user_id)
 
             save_roles()
             save_history()
@@ -1006,7 +1327,7 @@ async def scenario_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_data = bot_state.get_user_history(user_id, selected_file)
 
             if intro_scene and not user_data["history"]:
-                narrator_entry = f"Narrator: {intro_scene}"
+                narrator_entry = Turn.new(ROLE_NARRATOR, NARRATOR_NAME, intro_scene)
                 user_data["history"].append(narrator_entry)
                 bot_state.update_user_history(user_id, selected_file, user_data["history"])
                 save_history()
@@ -1016,27 +1337,9 @@ async def scenario_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # If history is not empty — show last two messages
             elif user_data["history"]:
                 recent_messages = user_data["history"][-2:]
+                char_emoji = _char_emoji_by_name(characters)
+                formatted = "\n".join(_format_turn(turn, char_emoji, user_emoji) for turn in recent_messages)
 
-                for line in recent_messages:
-                    if line.startswith("Narrator:"):
-                        text = line[len("Narrator:"):].strip()
-                        formatted =f"📜: {text}"
-                    elif line.startswith(f"{user_name}:"):
-                        text = line[len(f"{user_name}:"):].strip()
-                        formatted = f"{user_emoji}: {text}"
-                    else:
-                        # Checking every character for a match
-                        found = False
-                        for _, char_data in characters.items():
-                            if line.startswith(f"{char_data['name']}:"):
-                                text = line[len(f"{char_data['name']}:"):].strip()
-                                formatted = f"{char_data.get('emoji', '🤖')}: {text}"
-                                found = True
-                                break
-                        
-                        if not found:
-                            formatted = line
-                    
                 markdown_formatted = safe_markdown_v2(formatted)
                 await _safe_send_markdown(update, markdown_formatted, formatted)
 
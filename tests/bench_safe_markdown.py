@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tests/bench_safe_markdown.py
+# This file is part of the BotAnya Telegram Bot project.
+# Speed of safe_markdown_v2 against the old regex implementation on long replies.
+#
+# Run:  python tests/bench_safe_markdown.py [--chars 33000] [--repeat 50]
+
+import os
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils import safe_markdown_v2
+from markdown_reference import reference_safe_markdown_v2
+
+
+
+def _make_reply(chars: int, marked: bool) -> str:
+    rng = random.Random(1)
+    words = ["Она", "оглянулась", "на", "тёмный", "коридор", "и", "тихо", "сказала.", "Дверь", "открыта!"]
+    if marked:
+        words += ["**важно**", "*шёпотом*", "(в сторону)", "- пункт", "~", "a_b"]
+    parts, size = [], 0
+    while size < chars:
+        word = rng.choice(words)
+        parts.append(word)
+        size += len(word) + 1
+    return " ".join(parts)[:chars]
+
+
+
+def bench(chars: int, repeat: int):
+    for name, marked in (("разметка", True), ("обычный текст", False)):
+        text = _make_reply(chars, marked)
+        assert safe_markdown_v2(text) == reference_safe_markdown_v2(text)
+        old = min(timeit.repeat(lambda: reference_safe_markdown_v2(text), number=repeat, repeat=3)) / repeat
+        new = min(timeit.repeat(lambda: safe_markdown_v2(text), number=repeat, repeat=3)) / repeat
+        print(f"📊 {name:<14} {len(text)} символов: было {old * 1000:7.2f} мс, стало {new * 1000:7.2f} мс "
+              f"({old / new:.2f}x)")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="safe_markdown_v2 benchmark against the old implementation.")
+    parser.add_argument("--chars", type=int, default=33000, help="Length of the reply")
+    parser.add_argument("--repeat", type=int, default=50, help="Calls per measurement")
+    args = parser.parse_args()
+    bench(args.chars, args.repeat)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tests/markdown_reference.py
+# This file is part of the BotAnya Telegram Bot project.
+# The regex-based safe_markdown_v2 replaced by the single-pass version in utils.py,
+# kept as the oracle for the equivalence test and the benchmark.
+
+import re
+
+# telegram.helpers.escape_markdown(text, version=2), inlined so the oracle doesn't need the bot dependencies
+_ESCAPE_RE = re.compile("([{}])".format(re.escape(r"\_*[]()~`>#+-=|{}.!")))
+
+
+
+def escape_markdown_v2(text: str) -> str:
+    return _ESCAPE_RE.sub(r"\\\1", text)
+
+
+
+def reference_safe_markdown_v2(text: str) -> str:
+    if not text:
+        return ""
+
+    # 1. Save bold/italic formatting
+    text = re.sub(r'\*\*(.+?)\*\*', r'%%BOLD%%\1%%BOLD%%', text)
+    text = re.sub(r'\*(.+?)\*', r'%%ITALIC%%\1%%ITALIC%%', text)
+
+    # 2. Escape Markdown symbols
+    text = escape_markdown_v2(text)
+
+    # 3. Restore bold/italic formatting
+    text = text.replace('%%BOLD%%', '*')
+    text = text.replace('%%ITALIC%%', '_')
+
+    # 4. Remove last symbol if odd count
+    def remove_last_if_odd(symbol: str, raw: str) -> str:
+        count = raw.count(symbol)
+        if count % 2 != 0:
+            last_index = raw.rfind(symbol)
+            raw = raw[:last_index] + raw[last_index + 1:]
+        return raw
+
+    for sym in ['*', '_', '~']:
+        text = remove_last_if_odd(sym, text)
+
+    if text.count('[') != text.count(']'):
+        text = re.sub(r'\[.*$', '', text)
+    if text.count('(') != text.count(')'):
+        text = re.sub(r'\(.*$', '', text)
+
+    return text.strip()
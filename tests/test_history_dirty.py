@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tests/test_history_dirty.py
+# This file is part of the BotAnya Telegram Bot project.
+# Only changed history records are written by save_history(): reading a record must not mark it.
+#
+# Run:  python -m pytest tests
+
+from bot_state import bot_state
+from turns import Turn, PackedHistory, ROLE_USER
+
+USER_ID = "100"
+SCENARIO = "scenario.json"
+
+
+
+def _reset_state(monkeypatch, scenarios: dict):
+    monkeypatch.setattr(bot_state, "user_history", {USER_ID: scenarios})
+    monkeypatch.setattr(bot_state, "history_versions", {})
+    monkeypatch.setattr(bot_state, "dirty_histories", set())
+
+
+
+def test_read_does_not_mark_dirty(monkeypatch):
+    _reset_state(monkeypatch, {})
+    bot_state.update_user_history(USER_ID, SCENARIO, [Turn.new(ROLE_USER, "Пользователь", "привет")])
+    assert (USER_ID, SCENARIO) in bot_state.dirty_histories
+
+    bot_state.dirty_histories.clear()
+    bot_state.get_user_history(USER_ID, SCENARIO)
+    bot_state.is_valid_last_exchange(USER_ID, SCENARIO, "Аня", "Пользователь")
+    assert not bot_state.dirty_histories
+
+    bot_state.reset_user_history(USER_ID, SCENARIO)
+    assert (USER_ID, SCENARIO) in bot_state.dirty_histories
+
+
+
+def test_unpack_marks_dirty(monkeypatch):
+    packed = PackedHistory.pack({"history": [], "last_input": "", "last_bot_id": None})
+    _reset_state(monkeypatch, {SCENARIO: packed})
+
+    data = bot_state.get_user_history(USER_ID, SCENARIO)
+    assert data["history"] == []
+    assert (USER_ID, SCENARIO) in bot_state.dirty_histories
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tests/test_safe_markdown.py
+# This file is part of the BotAnya Telegram Bot project.
+# safe_markdown_v2 must give the same output as the old regex implementation.
+#
+# Run:  python -m pytest tests
+
+import random
+import pytest
+from utils import safe_markdown_v2
+from markdown_reference import reference_safe_markdown_v2
+
+# Markup characters are much more frequent than in real replies, to hit the pairing corner cases
+ALPHABET = "****__~~[]()\n\n  ab.!-\\`>#+=|{}я%"
+RANDOM_CASES = 50000
+
+
+
+def _random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40)))
+
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "   ",
+    "Привет!",
+    "**жирный** и *курсив*",
+    "***три звезды***",
+    "**не закрыт",
+    "*a\nb* **c\nd**",
+    "** **",
+    "****",
+    "список:\n- один.\n- два!",
+    "[ссылка](http://example.com)",
+    "скобка ( без пары",
+    "[без пары",
+    "~зачёркнутый~ и ~один",
+    "под_черк _и_ ещё",
+    "`код` > цитата # + = | { } . !",
+    "\\обратный\\слэш*",
+])
+def test_known_cases(text):
+    assert safe_markdown_v2(text) == reference_safe_markdown_v2(text)
+
+
+
+# Property: for any text (without the old "%%BOLD%%"/"%%ITALIC%%" placeholders, which the old
+# implementation turned into markup) both implementations agree
+def test_random_texts_match_reference():
+    rng = random.Random(20250101)
+    for _ in range(RANDOM_CASES):
+        text = _random_text(rng)
+        if "%%BOLD%%" in text or "%%ITALIC%%" in text:
+            continue
+        assert safe_markdown_v2(text) == reference_safe_markdown_v2(text), repr(text)
+
+
+
+def test_long_reply_matches_reference():
+    rng = random.Random(7)
+    words = ["**важно**", "*тихо*", "слово", "конец.", "(скобки)", "[x]", "a_b", "~", "-", "!", "\n"]
+    text = " ".join(rng.choice(words) for _ in range(6000))
+    assert safe_markdown_v2(text) == reference_safe_markdown_v2(text)
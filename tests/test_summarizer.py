@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tests/test_summarizer.py
+# This file is part of the BotAnya Telegram Bot project.
+# Storing a background summary must not invalidate caches keyed on the history version.
+#
+# Run:  python -m pytest tests
+
+import asyncio
+import summarizer as summarizer_module
+from bot_state import bot_state
+from summarizer import Summarizer
+from turns import Turn, ROLE_USER, ROLE_CHAR
+
+USER_ID = "100"
+SCENARIO = "scenario.json"
+
+
+
+def _history(turns: int) -> list:
+    return [Turn.new(ROLE_USER if i % 2 == 0 else ROLE_CHAR, "Аня", f"ход {i}") for i in range(turns)]
+
+
+
+def test_summary_keeps_history_version(monkeypatch):
+    monkeypatch.setattr(summarizer_module, "save_history", lambda: None)
+    monkeypatch.setattr(bot_state, "user_history", {USER_ID: {}})
+    monkeypatch.setattr(bot_state, "history_versions", {})
+    monkeypatch.setattr(bot_state, "dirty_histories", set())
+
+    bot_state.update_user_history(USER_ID, SCENARIO, _history(10))
+    data = bot_state.get_user_history(USER_ID, SCENARIO)
+    # /retry alternates are cached with this version (telegram_handlers._alternates_cache)
+    alternates_version = bot_state.get_history_version(USER_ID, SCENARIO)
+    bot_state.dirty_histories.clear()
+
+    async def send_func(user_id, prompt, state, service_key=None):
+        return "Краткое содержание.", 1
+
+    asyncio.run(Summarizer()._run((USER_ID, SCENARIO), data, 0, 6, send_func, {}, "service", 50))
+
+    assert data["summary"] == {"text": "Краткое содержание.", "turns": 6}
+    assert bot_state.get_history_version(USER_ID, SCENARIO) == alternates_version
+    assert (USER_ID, SCENARIO) in bot_state.dirty_histories
+
+
+
+def test_cut_history_drops_summary(monkeypatch):
+    monkeypatch.setattr(bot_state, "user_history", {USER_ID: {}})
+    monkeypatch.setattr(bot_state, "history_versions", {})
+    monkeypatch.setattr(bot_state, "dirty_histories", set())
+
+    history = _history(10)
+    bot_state.update_user_history(USER_ID, SCENARIO, history)
+    bot_state.set_summary(USER_ID, SCENARIO, {"text": "...", "turns": 9})
+    bot_state.update_user_history(USER_ID, SCENARIO, history[:8])
+    assert "summary" not in bot_state.get_user_history(USER_ID, SCENARIO)
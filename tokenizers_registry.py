@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# tokenizers_registry.py
+# This file is part of the BotAnya Telegram Bot project.
+# Per-service tokenizers for token budgets, and drift of the counts against Ollama.
+
+import os
+import json
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+from config import (BASE_DIR, TIKTOKEN_ENCODING, TOKENIZER_DRIFT_WARN, TOKENIZER_DRIFT_SAMPLES,
+                    TOKENIZER_THREADS)
+
+# Token counting runs here: tiktoken and tokenizers release the GIL while encoding
+tokenizer_pool = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+
+
+
+class TiktokenTokenizer:
+    def __init__(self, key: str, encoding_name: str = TIKTOKEN_ENCODING, path: str = None):
+        # imported here: the first tokenizer is loaded in the background after startup
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+        self.key = key
+        if path:
+            # BPE file in tiktoken format, split pattern of cl100k_base
+            base = tiktoken.get_encoding("cl100k_base")
+            self._encoding = tiktoken.Encoding(
+                name=os.path.basename(path),
+                pat_str=base._pat_str,
+                mergeable_ranks=load_tiktoken_bpe(path),
+                special_tokens={},
+            )
+        else:
+            self._encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        if len(texts) == 1:
+            return [self.count(texts[0])]
+        encoded = self._encoding.encode_batch(texts, num_threads=TOKENIZER_THREADS, disallowed_special=())
+        return [len(tokens) for tokens in encoded]
+
+
+
+class HFTokenizer:
+    def __init__(self, key: str, path: str):
+        # optional dependency, needed only for "hf" tokenizers
+        from tokenizers import Tokenizer
+        self.key = key
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(encoding.ids) for encoding in self._tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+
+class EstimateTokenizer:
+    def __init__(self, key: str, chars_per_token: float):
+        self.key = key
+        self._chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return int(len(text) / self._chars_per_token) + 1
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+
+
+TOKENIZER_TYPES = {
+    "tiktoken": lambda key, spec: TiktokenTokenizer(key, spec.get("encoding", TIKTOKEN_ENCODING),
+                                                   _resolve_path(spec.get("path"))),
+    "hf": lambda key, spec: HFTokenizer(key, _resolve_path(spec["path"])),
+    "estimate": lambda key, spec: EstimateTokenizer(key, float(spec.get("chars_per_token", 3.0))),
+}
+
+# tokenizer key -> future of the tokenizer loaded in tokenizer_pool ("" is the default tokenizer)
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+
+def _resolve_path(path: str):
+    if path and not os.path.isabs(path):
+        return os.path.join(BASE_DIR, path)
+    return path
+
+
+
+# Runs in tokenizer_pool: loading BPE/HF files takes long
+def _load_tokenizer(key: str, spec: dict):
+    if not spec:
+        return TiktokenTokenizer("")
+    try:
+        return TOKENIZER_TYPES[spec.get("type", "tiktoken")](key, spec)
+    except Exception as e:
+        print(f"⚠️ Не удалось загрузить токенайзер {spec}: {e}. Используется {TIKTOKEN_ENCODING}.")
+        return TiktokenTokenizer("")
+
+
+
+# Future of the service tokenizer; each tokenizer is loaded once, even by concurrent callers
+def _tokenizer_future(service_config: dict) -> Future:
+    spec = (service_config or {}).get("tokenizer")
+    key = json.dumps(spec, sort_keys=True) if spec else ""
+    with _tokenizers_lock:
+        future = _tokenizers.get(key)
+        if future is None:
+            future = _tokenizers[key] = tokenizer_pool.submit(_load_tokenizer, key, spec)
+    return future
+
+
+
+# Tokenizer of the service: "tokenizer" setting, loaded once in tokenizer_pool and cached
+async def get_tokenizer(service_config: dict):
+    """
+    "tokenizer": {"type": "hf", "path": "tokenizers/qwen2.5/tokenizer.json"}
+                 {"type": "tiktoken", "encoding": "cl100k_base"} or {"type": "tiktoken", "path": "model.tiktoken"}
+                 {"type": "estimate", "chars_per_token": 2.6}
+    Without the setting (or if the tokenizer can't be loaded) the default tiktoken encoding is used.
+    The event loop only waits for the loading (started by warm_up_tokenizers() or by the first call).
+    """
+    future = _tokenizer_future(service_config)
+    if future.done():
+        return future.result()
+    return await asyncio.wrap_future(future)
+
+
+
+# Loading tokenizers of the services in tokenizer_pool, so the first message does not wait for them
+def warm_up_tokenizers(service_configs):
+    _tokenizer_future(None)
+    for service_config in service_configs:
+        _tokenizer_future(service_config)
+
+
+
+# Token counts of the texts, computed in tokenizer_pool
+async def count_tokens(tokenizer, texts: List[str]) -> List[int]:
+    if not texts:
+        return []
+    return await asyncio.get_running_loop().run_in_executor(tokenizer_pool, tokenizer.count_batch, texts)
+
+
+
+class TokenizerDrift:
+    """
+    Compares our prompt token counts with prompt_eval_count reported by Ollama.
+    Samples far below the estimate are skipped: Ollama reused its prompt cache
+    and evaluated only the tail of the prompt.
+    """
+
+    def __init__(self):
+        self._stats = {}   # model -> [samples, sum of actual/estimated, chars, actual tokens]
+
+
+    def report(self, model: str, estimated: int, actual: int, chars: int, debug: bool = False):
+        if not estimated or not actual or actual < estimated / 2:
+            return
+        stats = self._stats.setdefault(model, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += actual / estimated
+        stats[2] += chars
+        stats[3] += actual
+
+        drift = actual / estimated - 1
+        if debug:
+            print(f"📏 Токены {model}: оценка {estimated}, Ollama {actual} ({drift:+.0%})")
+
+        if stats[0] >= TOKENIZER_DRIFT_SAMPLES:
+            average = stats[1] / stats[0] - 1
+            if abs(average) >= TOKENIZER_DRIFT_WARN:
+                print(f"⚠️ Расхождение счётчика токенов для {model}: {average:+.0%} в среднем "
+                      f"по {stats[0]} запросам. Подходящий estimate: chars_per_token={stats[2] / stats[3]:.2f}")
+            self._stats[model] = [0, 0.0, 0, 0]
+
+
+
+# TokenizerDrift instance
+tokenizer_drift = TokenizerDrift()
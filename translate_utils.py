@@ -6,34 +6,36 @@
 # This file is part of the BotAnya Telegram Bot project.
 
 import re
-from deep_translator import (
-    GoogleTranslator,
-    DeeplTranslator,
-    MyMemoryTranslator,
-    YandexTranslator,
-    MicrosoftTranslator
-)
+import asyncio
 from bot_state import bot_state
-from config import MAX_PART_SIZE
+from config import MAX_PART_SIZE, STREAM_TRANSLATE_MIN_CHARS
 
+# deep_translator classes; the package is imported on the first translation
 TRANSLATOR_CLASSES = {
-    "google": GoogleTranslator,
-    "deepl": DeeplTranslator,
-    "mymemory": MyMemoryTranslator,
-    "yandex": YandexTranslator,
-    "microsoft": MicrosoftTranslator,
+    "google": "GoogleTranslator",
+    "deepl": "DeeplTranslator",
+    "mymemory": "MyMemoryTranslator",
+    "yandex": "YandexTranslator",
+    "microsoft": "MicrosoftTranslator",
 }
 
 
 
+# Sentence delimiters used to cut text into translatable parts
+SENTENCE_DELIMITERS = [". ", "\n", "!", "?", ";"]
+
+
+
+def _rfind_delimiter(text: str, end: int) -> int:
+    return max(text.rfind(delim, 0, end) for delim in SENTENCE_DELIMITERS)
+
+
+
 def _split_text_by_length(text: str, max_len: int = MAX_PART_SIZE):
 
     parts = []
     while len(text) > max_len:
-        idx = max(
-            text.rfind(delim, 0, max_len)
-            for delim in [". ", "\n", "!", "?", ";"]
-        )
+        idx = _rfind_delimiter(text, max_len)
         if idx <= 0:
             idx = max_len
         parts.append(text[:idx].strip())
@@ -44,10 +46,29 @@ def _split_text_by_length(text: str, max_len: int = MAX_PART_SIZE):
 
 
 
+# Cutting streamed text after the last finished sentence
+def _split_complete_sentences(text: str, min_len: int = STREAM_TRANSLATE_MIN_CHARS):
+    """
+    Returns (finished_part, rest). The delimiter must be followed by at least one
+    more character, otherwise the sentence may still be growing ("?!", "...").
+    """
+    idx = _rfind_delimiter(text, len(text) - 1)
+    if idx < 0 or idx + 1 < min_len:
+        return "", text
+    return text[:idx + 1], text[idx + 1:]
+
+
+
+
+def _translator_class(svc_name: str):
+    import deep_translator
+    return getattr(deep_translator, TRANSLATOR_CLASSES.get(svc_name, TRANSLATOR_CLASSES["google"]))
+
+
 
 def _get_translator(target_lang: str):
     svc_name = bot_state.config.get("translation_service", "google").lower()
-    cls = TRANSLATOR_CLASSES.get(svc_name, GoogleTranslator)
+    cls = _translator_class(svc_name)
     creds = bot_state.credentials.get("services", {}).get(svc_name, {})
     api_key = creds.get("api_key") or creds.get("auth_key")
 
@@ -56,7 +77,7 @@ def _get_translator(target_lang: str):
     except TypeError:
         if api_key:
             return cls(source="auto", target=target_lang, api_key=api_key)
-        return GoogleTranslator(source="auto", target=target_lang)
+        return _translator_class("google")(source="auto", target=target_lang)
 
 
 
@@ -100,6 +121,85 @@ def _translate_prompt(prompt: str, target_lang: str = "en") -> str:
 
     return "\n".join(translated_blocks)
 
+
+# Streaming reverse translation
+class StreamingTranslator:
+    """
+    Translates a streamed model reply sentence by sentence while generation continues.
+
+    feed() receives raw deltas from the model, finished sentences are translated in a
+    worker thread, on_update(text) gets the translated text collected so far.
+    finish() flushes the tail and returns the whole translation.
+    """
+    def __init__(self, target_lang: str = "ru", on_update=None):
+        self._translator = _get_translator(target_lang)
+        self._on_update = on_update
+        self._buffer = ""
+        self._parts = []
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts).strip()
+
+
+    async def feed(self, delta: str):
+        self._buffer += delta
+        ready, self._buffer = _split_complete_sentences(self._buffer)
+        if ready:
+            self._queue.put_nowait(ready)
+
+
+    async def finish(self) -> str:
+        if self._buffer.strip():
+            self._queue.put_nowait(self._buffer)
+        self._buffer = ""
+        self._queue.put_nowait(None)
+        await self._worker
+        return self.text
+
+
+    def cancel(self):
+        if not self._worker.done():
+            self._worker.cancel()
+
+
+    async def _run(self):
+        done = False
+        while not done:
+            chunk = await self._queue.get()
+            if chunk is None:
+                break
+            # Merging everything that was finished while the previous part was translated
+            while not self._queue.empty():
+                extra = self._queue.get_nowait()
+                if extra is None:
+                    done = True
+                    break
+                chunk += extra
+
+            content = chunk.strip()
+            if not content:
+                continue
+            lead = chunk[:len(chunk) - len(chunk.lstrip())]
+            if self._parts:
+                lead = "\n" * lead.count("\n") or " "
+            else:
+                lead = ""
+
+            translated = await asyncio.to_thread(_safe_translate, self._translator, content)
+            self._parts.append(lead + translated)
+
+            if self._on_update:
+                try:
+                    await self._on_update(self.text)
+                except Exception as e:
+                    print(f"⚠️ Stream update failed: {e}")
+
+
+
 def translate_prompt_to_english(prompt: str) -> str:
     return _translate_prompt(prompt, target_lang="en")
 
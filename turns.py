@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# turns.py
+# This file is part of the BotAnya Telegram Bot project.
+# Structured history entries instead of "Name: text" strings.
+
+import json
+import time
+import zlib
+import base64
+
+# Speaker roles
+ROLE_USER = "user"
+ROLE_CHAR = "char"
+ROLE_NARRATOR = "narrator"
+
+NARRATOR_NAME = "Narrator"
+
+
+
+class Turn:
+    """
+    One history entry. role, speaker, text and ts are fixed: to change an entry, replace it
+    with a new Turn (caches are keyed by turn identity). tokens and tokens_key are a mutable
+    cache of the token count, set in place whenever the turn is counted (by any tokenizer).
+
+    role    — ROLE_USER, ROLE_CHAR or ROLE_NARRATOR
+    speaker — display name (user name, character name or "Narrator")
+    text    — message text without the speaker prefix
+    tokens  — cached token count of line(), None if not counted yet
+    ts      — unix time of the entry, None for entries converted from old history
+    tokens_key — key of the tokenizer that counted tokens ("" — default tokenizer, the only one saved)
+    """
+    __slots__ = ("role", "speaker", "text", "tokens", "ts", "tokens_key")
+
+    def __init__(self, role: str, speaker: str, text: str, tokens: int = None, ts: int = None):
+        self.role = role
+        self.speaker = speaker
+        self.text = text
+        self.tokens = tokens
+        self.ts = ts
+        self.tokens_key = ""
+
+
+    @classmethod
+    def new(cls, role: str, speaker: str, text: str) -> "Turn":
+        return cls(role, speaker, text, None, int(time.time()))
+
+
+    # "Name: text" line as it was stored before
+    def line(self) -> str:
+        return f"{self.speaker}: {self.text}"
+
+
+    # Compact JSON form: [role, speaker, text, tokens, ts]
+    def to_json(self) -> list:
+        tokens = self.tokens if self.tokens_key == "" else None
+        return [self.role, self.speaker, self.text, tokens, self.ts]
+
+
+    def __repr__(self):
+        return f"Turn({self.role!r}, {self.speaker!r}, {self.text[:30]!r})"
+
+
+
+# Parsing the old "Name: text" entry
+def parse_legacy_turn(line: str, user_name: str, char_names=()) -> Turn:
+    """
+    Known names are matched as whole prefixes (longest first), so names with colons work.
+    """
+    if line.startswith(f"{NARRATOR_NAME}:"):
+        return Turn(ROLE_NARRATOR, NARRATOR_NAME, line[len(NARRATOR_NAME) + 1:].strip())
+    if user_name and line.startswith(f"{user_name}:"):
+        return Turn(ROLE_USER, user_name, line[len(user_name) + 1:].strip())
+    for name in sorted(char_names, key=len, reverse=True):
+        if line.startswith(f"{name}:"):
+            return Turn(ROLE_CHAR, name, line[len(name) + 1:].strip())
+
+    speaker, sep, text = line.partition(":")
+    if not sep:
+        return Turn(ROLE_NARRATOR, NARRATOR_NAME, line.strip())
+    return Turn(ROLE_CHAR, speaker.strip(), text.strip())
+
+
+
+# Loading a history entry: a new list record or an old string
+def turn_from_json(data, user_name: str = "", char_names=()) -> Turn:
+    if isinstance(data, str):
+        return parse_legacy_turn(data, user_name, char_names)
+    return Turn(*data)
+
+
+
+# json.dump default= hook
+def turn_to_json(obj):
+    if isinstance(obj, Turn):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+
+# Compressed history of an inactive scenario
+class PackedHistory:
+    """
+    zlib-compressed JSON of a scenario history record ({"history", "last_input", "last_bot_id", ...}).
+    Stored in history.json as {"zlib": "<base64>"}, in the snapshot as {"zlib": <bytes>},
+    in SQLite as a blob with packed = 1.
+    """
+    __slots__ = ("blob",)
+
+    def __init__(self, blob: bytes):
+        self.blob = blob
+
+
+    @classmethod
+    def pack(cls, data: dict) -> "PackedHistory":
+        raw = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=turn_to_json)
+        return cls(zlib.compress(raw.encode("utf-8")))
+
+
+    def unpack(self) -> dict:
+        data = json.loads(zlib.decompress(self.blob).decode("utf-8"))
+        data["history"] = [turn_from_json(entry) for entry in data.get("history", [])]
+        return data
+
+
+    def to_json(self) -> dict:
+        return {"zlib": base64.b64encode(self.blob).decode("ascii")}
+
+
+    @classmethod
+    def from_json(cls, data: dict) -> "PackedHistory":
+        blob = data["zlib"]
+        return cls(blob if isinstance(blob, bytes) else base64.b64decode(blob))
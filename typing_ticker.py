@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# typing_ticker.py
+# This file is part of the BotAnya Telegram Bot project.
+# One scheduler for "typing..." indicators of all chats with an active generation.
+
+import asyncio
+import contextlib
+from telegram.constants import ChatAction
+from config import TYPING_INTERVAL
+
+
+
+class TypingTicker:
+    """
+    Keeps the set of chats whose requests are being decoded right now and sends
+    typing actions for them on a single timer.
+    Actions go through bot.send_chat_action, i.e. through the outbound rate limiter; each one runs
+    as its own task, so a chat paused by RetryAfter doesn't hold up the others. A chat whose
+    previous action is still waiting is skipped.
+    """
+
+    def __init__(self, interval: float = TYPING_INTERVAL):
+        self._interval = interval
+        self._active = {}      # chat_id -> number of active generations
+        self._last_sent = {}   # chat_id -> loop time of the last typing action
+        self._sending = {}     # chat_id -> task of the typing action not sent yet
+        self._bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+
+    def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for task in list(self._sending.values()):
+            task.cancel()
+        await asyncio.gather(*self._sending.values(), return_exceptions=True)
+
+
+    # Marks the chat as "decoding" while the block is running
+    @contextlib.asynccontextmanager
+    async def decoding(self, chat_id):
+        self._active[chat_id] = self._active.get(chat_id, 0) + 1
+        self._wakeup.set()
+        try:
+            yield
+        finally:
+            count = self._active.get(chat_id, 1) - 1
+            if count > 0:
+                self._active[chat_id] = count
+            else:
+                self._active.pop(chat_id, None)
+                self._last_sent.pop(chat_id, None)
+
+
+    async def _send(self, chat_id):
+        try:
+            await self._bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e:
+            print(f"⚠️ Не удалось отправить typing в {chat_id}: {e}")
+        finally:
+            self._sending.pop(chat_id, None)
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+
+            due = [chat_id for chat_id in self._active
+                   if now - self._last_sent.get(chat_id, float("-inf")) >= self._interval]
+            for chat_id in due:
+                self._last_sent[chat_id] = now
+                if self._bot and chat_id not in self._sending:
+                    self._sending[chat_id] = asyncio.create_task(self._send(chat_id))
+
+            # Sleeping until the next chat is due or a new chat appears
+            timeout = None
+            if self._last_sent:
+                timeout = max(min(self._last_sent.values()) + self._interval - loop.time(), 0.0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+
+# TypingTicker instance
+typing_ticker = TypingTicker()
@@ -6,91 +6,349 @@
 # This file is part of the BotAnya Telegram Bot project.
 
 import re
-from telegram.helpers import escape_markdown
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import partial
 from typing import List
+from turns import Turn, ROLE_USER, ROLE_NARRATOR
+from tokenizers_registry import count_tokens
+from config import PROMPT_TOKENS_CACHE_SIZE, PROMPT_CACHE_USERS, TOKENIZER_BATCH
 
 
 
 
-# Markdown shielding
-def safe_markdown_v2(text: str) -> str:
-    if not text:
-        return ""
+# MarkdownV2 special characters and their escaped form (backslash goes first)
+_MD_V2_ESCAPES = tuple((c, "\\" + c) for c in r"\_*[]()~`>#+-=|{}.!")
+
+_STAR_RE = re.compile(r"\*")
+_NEWLINE_RE = re.compile(r"\n")
 
-    # 1. Save bold/italic formatting
-    text = re.sub(r'\*\*(.+?)\*\*', r'%%BOLD%%\1%%BOLD%%', text)
-    text = re.sub(r'\*(.+?)\*', r'%%ITALIC%%\1%%ITALIC%%', text)
+# Private-use characters standing for markup while the text is escaped
+_MD_BOLD = "\ue000"
+_MD_ITALIC = "\ue001"
+_MD_BACKSLASH = "\ue002"
+_MD_SENTINELS = ((_MD_BOLD, "*"), (_MD_ITALIC, "_"), (_MD_BACKSLASH, "\\"))
 
-    # 2. Escape Markdown symbols
-    text = escape_markdown(text, version=2)
 
-    # 3. Restore bold/italic formatting
-    text = text.replace('%%BOLD%%', '*')
-    text = text.replace('%%ITALIC%%', '_')
 
-    # 4. Remove last symbol if odd count
-    def remove_last_if_odd(symbol: str, raw: str) -> str:
-        count = raw.count(symbol)
-        if count % 2 != 0:
-            last_index = raw.rfind(symbol)
-            raw = raw[:last_index] + raw[last_index + 1:]
-        return raw
+def _escape_markdown_v2(text: str) -> str:
+    for char, escaped in _MD_V2_ESCAPES:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
 
-    for sym in ['*', '_', '~']:
-        text = remove_last_if_odd(sym, text)
 
-    if text.count('[') != text.count(']'):
-        text = re.sub(r'\[.*$', '', text)
-    if text.count('(') != text.count(')'):
-        text = re.sub(r'\(.*$', '', text)
 
-    return text.strip()
+# Pairing of **bold** and *italic* markers
+def _pair_markdown_stars(text: str):
+    """
+    Finds **bold** and *italic* pairs with the rules of the former regexes:
+    leftmost and shortest match first, non-empty content, no line breaks inside, bold first.
+    Works only with star positions, so the cost is O(n) for the search plus O(stars).
 
+    :return: (bold, italic, loose) — lists of (open, close) positions and positions of literal stars.
+    """
+    stars = [match.start() for match in _STAR_RE.finditer(text)]
+    count = len(stars)
+    if not count:
+        return [], [], []
+
+    # Line number of every star
+    newlines = [match.start() for match in _NEWLINE_RE.finditer(text)]
+    lines = [bisect_left(newlines, pos) for pos in stars] if newlines else [0] * count
+
+    # next_double[k] — index of the first star >= k which starts "**"
+    next_double = [count] * (count + 1)
+    for k in range(count - 2, -1, -1):
+        next_double[k] = k if stars[k + 1] == stars[k] + 1 else next_double[k + 1]
+
+    # 1. **bold**
+    bold = []
+    used = [False] * count
+    k = 0
+    while k < count - 1:
+        start = stars[k]
+        if stars[k + 1] == start + 1:
+            first = k + 2
+            if first < count and stars[first] == start + 2:
+                first += 1
+            close = next_double[first] if first < count else count
+            if close < count and lines[close] == lines[k]:
+                bold.append((start, stars[close]))
+                used[k] = used[k + 1] = used[close] = used[close + 1] = True
+                k = close + 2
+                continue
+        k += 1
+
+    # 2. *italic* among the remaining stars
+    italic = []
+    loose = []
+    rest = [k for k in range(count) if not used[k]]
+    i = 0
+    while i < len(rest):
+        start = stars[rest[i]]
+        close = i + 1
+        if close < len(rest) and stars[rest[close]] == start + 1:
+            close += 1
+        if close < len(rest) and lines[rest[close]] == lines[rest[i]]:
+            italic.append((start, stars[rest[close]]))
+            # an adjacent star is part of the content and stays literal
+            if close == i + 2:
+                loose.append(stars[rest[i + 1]])
+            i = close + 1
+            continue
+        loose.append(start)
+        i += 1
+
+    return bold, italic, loose
+
+
+
+# Removing an unclosed "[" or "(" with the rest of the last line
+def _cut_unclosed(text: str, symbol: str) -> str:
+    end = len(text) - 1 if text.endswith("\n") else len(text)
+    start = text.rfind("\n", 0, end) + 1
+    idx = text.find(symbol, start, end)
+    if idx == -1:
+        return text
+    return text[:idx] + text[end:]
+
+
+
+# Markdown shielding
+def safe_markdown_v2(text: str) -> str:
+    """
+    Single pass MarkdownV2 sanitizer:
+        - **bold** -> *bold*, *italic* -> _italic_,
+        - all other special characters are escaped,
+        - the last "*", "_" or "~" is removed if its count is odd,
+        - an unclosed "[" or "(" is cut off with the rest of the last line.
+    """
+    if not text:
+        return ""
+
+    bold, italic, loose = _pair_markdown_stars(text)
+
+    # Markup is written as sentinels and the whole text is escaped at once.
+    # If the text already contains a sentinel, segments are escaped one by one.
+    use_sentinels = not any(sentinel in text for sentinel, _ in _MD_SENTINELS)
+    if use_sentinels:
+        bold_mark, italic_mark, backslash = _MD_BOLD, _MD_ITALIC, _MD_BACKSLASH
+    else:
+        bold_mark, italic_mark, backslash = "*", "_", "\\"
+
+    # Events: (position, length in source, output)
+    events = []
+    for start, close in bold:
+        events.append((start, 2, bold_mark))
+        events.append((close, 2, bold_mark))
+    for start, close in italic:
+        events.append((start, 1, italic_mark))
+        events.append((close, 1, italic_mark))
+
+    # The last symbol of an odd count is dropped (an escaped one leaves its backslash)
+    if len(loose) % 2:
+        if not bold or loose[-1] > bold[-1][1]:
+            events.append((loose[-1], 1, backslash))
+        else:
+            events[2 * len(bold) - 1] = (bold[-1][1], 2, "")
+    if text.count("_") % 2:
+        last = text.rfind("_")
+        if not italic or last > italic[-1][1]:
+            events.append((last, 1, backslash))
+        else:
+            events[2 * len(bold) + 2 * len(italic) - 1] = (italic[-1][1], 1, "")
+    if text.count("~") % 2:
+        events.append((text.rfind("~"), 1, backslash))
+
+    events.sort()
+
+    parts = []
+    last = 0
+    for pos, length, piece in events:
+        parts.append(text[last:pos] if use_sentinels else _escape_markdown_v2(text[last:pos]))
+        parts.append(piece)
+        last = pos + length
+    parts.append(text[last:] if use_sentinels else _escape_markdown_v2(text[last:]))
+    result = "".join(parts)
+
+    if use_sentinels:
+        result = _escape_markdown_v2(result)
+        for sentinel, markup in _MD_SENTINELS:
+            if sentinel in result:
+                result = result.replace(sentinel, markup)
+
+    # Unclosed links/brackets
+    cut = False
+    if text.count("[") != text.count("]"):
+        result = _cut_unclosed(result, "[")
+        cut = True
+    if cut:
+        unbalanced = result.count("(") != result.count(")")
+    else:
+        unbalanced = text.count("(") != text.count(")")
+    if unbalanced:
+        result = _cut_unclosed(result, "(")
+
+    return result.strip()
+
+
+
+
+# Token count of the turn, cached in the turn for the last used tokenizer
+def count_turn_tokens(turn: Turn, tokenizer) -> int:
+    if turn.tokens is None or turn.tokens_key != tokenizer.key:
+        turn.tokens = tokenizer.count(turn.line() + "\n")
+        turn.tokens_key = tokenizer.key
+    return turn.tokens
+
+
+
+# Counting the last turns of the history (enough for max_tokens) in batches, outside of the event loop
+async def count_history_tokens(history: List[Turn], tokenizer, max_tokens: int):
+    counted = 0
+    pending = []
+    for turn in history[::-1]:
+        if counted > max_tokens:
+            break
+        if turn.tokens is not None and turn.tokens_key == tokenizer.key:
+            counted += turn.tokens
+            continue
+        pending.append(turn)
+        if len(pending) == TOKENIZER_BATCH:
+            counted += await _count_turns(pending, tokenizer)
+            pending = []
+    if pending:
+        await _count_turns(pending, tokenizer)
+
+
+async def _count_turns(turns: List[Turn], tokenizer) -> int:
+    counts = await count_tokens(tokenizer, [turn.line() + "\n" for turn in turns])
+    for turn, tokens in zip(turns, counts):
+        turn.tokens = tokens
+        turn.tokens_key = tokenizer.key
+    return sum(counts)
 
 
 
 # Trimming history to fit into max_tokens
-def smart_trim_history(history, enc, max_tokens=6000):
+def smart_trim_history(history: List[Turn], tokenizer, max_tokens=6000):
     trimmed_dialogue = []
     dialogue_tokens = 0
 
-    for msg in reversed(history):
-        msg_tokens = len(enc.encode(msg + "\n"))
-        if dialogue_tokens + msg_tokens <= max_tokens:
-            trimmed_dialogue.insert(0, msg)
-            dialogue_tokens += msg_tokens
+    for turn in reversed(history):
+        count_turn_tokens(turn, tokenizer)
+        if dialogue_tokens + turn.tokens <= max_tokens:
+            trimmed_dialogue.append(turn)
+            dialogue_tokens += turn.tokens
         else:
             break
 
+    trimmed_dialogue.reverse()
     return trimmed_dialogue, dialogue_tokens
 
 
 
 
+# (tokenizer key, text) -> token count of recently used prompt pieces
+_prompt_tokens = OrderedDict()
+
+
+# Token count of a prompt piece; system and scene prompts repeat for every message of a user
+async def count_prompt_tokens(tokenizer, text: str) -> int:
+    key = (tokenizer.key, text)
+    tokens = _prompt_tokens.get(key)
+    if tokens is not None:
+        _prompt_tokens.move_to_end(key)
+        return tokens
+
+    tokens = (await count_tokens(tokenizer, [text]))[0]
+    _prompt_tokens[key] = tokens
+    while len(_prompt_tokens) > PROMPT_TOKENS_CACHE_SIZE:
+        _prompt_tokens.popitem(last=False)
+    return tokens
+
+
+
+# ChatML tags of speaker roles (a character other than the current one is tagged by name)
+_CHATML_TAGS = {
+    ROLE_USER: "user",
+    ROLE_NARRATOR: "system",
+}
+
+
+
+# Cache of rendered history blocks
+class PromptBlockCache:
+    """
+    user_id -> {(scenario_file, format, char_name): {id(turn): (turn, block)}}.
+    Only blocks of the last rendered history are kept: a new turn renders one block,
+    turns trimmed from the front are dropped. Turns are immutable, so a block is valid
+    while the same turn object is in the history.
+    """
+
+    def __init__(self, max_users: int = PROMPT_CACHE_USERS):
+        self._max_users = max_users
+        self._users = OrderedDict()
+
+
+    def blocks(self, cache_key: tuple, history: List[Turn], render) -> List[str]:
+        user_id, *key = cache_key
+        user_cache = self._users.pop(user_id, {})
+        self._users[user_id] = user_cache
+        while len(self._users) > self._max_users:
+            self._users.popitem(last=False)
+
+        cached = user_cache.get(tuple(key), {})
+        rendered = {}
+        result = []
+        for turn in history:
+            entry = cached.get(id(turn))
+            if entry is None or entry[0] is not turn:
+                entry = (turn, render(turn))
+            rendered[id(turn)] = entry
+            result.append(entry[1])
+        user_cache[tuple(key)] = rendered
+        return result
+
+
+    # Dropping blocks of the user (/edit, /retry, /reset)
+    def invalidate(self, user_id: str):
+        self._users.pop(str(user_id), None)
+
+
+
+# PromptBlockCache instance
+prompt_cache = PromptBlockCache()
+
+
+
+def _render_chatml_block(turn: Turn, current_char_name: str) -> str:
+    tag = _CHATML_TAGS.get(turn.role)
+    if tag is None:
+        tag = "assistant" if turn.speaker == current_char_name else turn.speaker
+    return f"<|im_start|>{tag}\n{turn.text}<|im_end|>"
+
+
+
 # building ChatML prompt without tail
 def _assemble_chatml_blocks(
     system_prompt: str,
-    history: List[str],
-    user_name: str,
-    current_char_name: str
+    history: List[Turn],
+    current_char_name: str,
+    cache_key: tuple = None
 ) -> List[str]:
     """
     building ChatML prompts without <|im_start|>assistant\n
+    cache_key = (user_id, scenario_file) enables the block cache
     """
     blocks = [f"<|im_start|>system\n{system_prompt}<|im_end|>"]
-    for msg in history:
-        if msg.startswith(f"{user_name}:"):
-            text = msg[len(user_name)+1:].strip()
-            blocks.append(f"<|im_start|>user\n{text}<|im_end|>")
-        elif msg.startswith("Narrator:"):
-            text = msg[len("Narrator:"):].strip()
-            blocks.append(f"<|im_start|>system\n{text}<|im_end|>")
-        else:
-            speaker, text = msg.split(":", 1)
-            speaker = speaker.strip()
-            text = text.strip()
-            tag = "assistant" if speaker == current_char_name else speaker
-            blocks.append(f"<|im_start|>{tag}\n{text}<|im_end|>")
+    render = partial(_render_chatml_block, current_char_name=current_char_name)
+    if cache_key:
+        blocks += prompt_cache.blocks((*cache_key, "chatml", current_char_name), history, render)
+    else:
+        blocks += [render(turn) for turn in history]
     return blocks
 
 
@@ -98,22 +356,26 @@ def _assemble_chatml_blocks(
 # building plain text prompt without tail
 def _assemble_plain_history(
     base_prompt: str,
-    history: List[str]
+    history: List[Turn],
+    cache_key: tuple = None
 ) -> str:
-
-    return f"{base_prompt}\n" + "\n".join(history)
+    if cache_key:
+        lines = prompt_cache.blocks((*cache_key, "plain"), history, Turn.line)
+    else:
+        lines = [turn.line() for turn in history]
+    return f"{base_prompt}\n" + "\n".join(lines)
 
 
 
 # building ChatML prompt with tail
 def build_chatml_prompt(
     system_prompt: str,
-    history: List[str],
-    user_name: str,
-    current_char_name: str
+    history: List[Turn],
+    current_char_name: str,
+    cache_key: tuple = None
 ) -> str:
 
-    blocks = _assemble_chatml_blocks(system_prompt, history, user_name, current_char_name)
+    blocks = _assemble_chatml_blocks(system_prompt, history, current_char_name, cache_key)
     blocks.append("<|im_start|>assistant\n")
     return "\n".join(blocks)
 
@@ -122,22 +384,89 @@ def build_chatml_prompt(
 # building ChatML prompt without tail
 def build_chatml_prompt_no_tail(
     system_prompt: str,
-    history: List[str],
-    user_name: str,
-    current_char_name: str
+    history: List[Turn],
+    current_char_name: str,
+    cache_key: tuple = None
 ) -> str:
-    return "\n".join(_assemble_chatml_blocks(system_prompt, history, user_name, current_char_name))
+    return "\n".join(_assemble_chatml_blocks(system_prompt, history, current_char_name, cache_key))
+
+
+
+# building message list for chat APIs (Ollama /api/chat, OpenAI, GigaChat)
+def build_chat_messages(
+    system_prompt: str,
+    history: List[Turn],
+    current_char_name: str
+) -> List[dict]:
+    """
+    Narrator turns become system messages, replies of the current character — assistant messages.
+    Other characters are shown to the model as user messages with the speaker name.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    for turn in history:
+        if turn.role == ROLE_USER:
+            messages.append({"role": "user", "content": turn.text})
+        elif turn.role == ROLE_NARRATOR:
+            messages.append({"role": "system", "content": turn.text})
+        elif turn.speaker == current_char_name:
+            messages.append({"role": "assistant", "content": turn.text})
+        else:
+            messages.append({"role": "user", "content": turn.line()})
+    return messages
+
+
+
+# /continue for chat APIs: the messages end on the character's reply, so the model is asked to go on with it
+def add_continue_cue(messages: List[dict], current_char_name: str) -> List[dict]:
+    return messages + [{
+        "role": "user",
+        "content": f"Продолжи последнюю реплику персонажа {current_char_name} с того места, где она оборвалась, "
+                   f"не повторяя уже написанное."
+    }]
+
+
+
+# translating contents of chat messages
+def translate_messages(messages: List[dict], translate_func) -> List[dict]:
+    return [{**message, "content": translate_func(message["content"])} for message in messages]
+
+
+
+# background tasks that fill alternates (references keep them from being garbage collected)
+_alternates_tasks = set()
+
+
+
+# Adding alternative completions to the retry cache list
+def add_alternates(alternates: list, texts: list, translate_func=None):
+    """
+    Texts are appended to alternates right away, or one by one after translate_func
+    runs in a thread, so the main answer is not delayed by the translation.
+    """
+    texts = [text.strip() for text in texts if text and text.strip()]
+    if not translate_func:
+        alternates.extend(texts)
+        return
+
+    async def _translate():
+        for text in texts:
+            alternates.append(await asyncio.to_thread(translate_func, text))
+
+    task = asyncio.create_task(_translate())
+    _alternates_tasks.add(task)
+    task.add_done_callback(_alternates_tasks.discard)
 
 
 
 # building plain text prompt with tail
 def build_plain_prompt(
     base_prompt: str,
-    history: List[str],
-    current_char_name: str
+    history: List[Turn],
+    current_char_name: str,
+    cache_key: tuple = None
 ) -> str:
 
-    plain = _assemble_plain_history(base_prompt, history)
+    plain = _assemble_plain_history(base_prompt, history, cache_key)
     return f"{plain}\n{current_char_name}:"
 
 
@@ -145,16 +474,17 @@ def build_plain_prompt(
 # building plain text prompt without tail
 def build_plain_prompt_no_tail(
     base_prompt: str,
-    history: List[str]
+    history: List[Turn],
+    cache_key: tuple = None
 ) -> str:
-    return _assemble_plain_history(base_prompt, history)
+    return _assemble_plain_history(base_prompt, history, cache_key)
 
 
 
 
 
 # Scene-prompt builder
-def build_scene_prompt(world_prompt: str, char: dict, user_emoji: str, user_name: str, user_role: str, recent_history: List[str] = None) -> str:
+def build_scene_prompt(world_prompt: str, char: dict, user_emoji: str, user_name: str, user_role: str, recent_history: List[Turn] = None) -> str:
     base_prompt = (
         f"{world_prompt.strip()}\n\n"
         f"Ты пишешь сцену в жанре ролевой игры.\n"
@@ -167,7 +497,7 @@ def build_scene_prompt(world_prompt: str, char: dict, user_emoji: str, user_name
     )
     
     if recent_history:
-        history_text = "\n".join(recent_history)
+        history_text = "\n".join(turn.line() for turn in recent_history)
         base_prompt += f"Последние события диалога:\n{history_text}\n\n"    
     
     return base_prompt
@@ -197,3 +527,36 @@ def wrap_chatml_prompt(prompt: str) -> str:
     wrapped = f"<|im_start|>system\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
     return wrapped
 
+
+
+
+# Adding recalled old turns to the system prompt
+def add_memories_to_prompt(system_prompt: str, memories: List[Turn]) -> str:
+    if not memories:
+        return system_prompt
+    memory_text = "\n".join(turn.line() for turn in memories)
+    return f"{system_prompt}\n\nВоспоминания из более ранней части диалога:\n{memory_text}"
+
+
+
+
+# Summary prompt builder (previous summary + turns that left the prompt)
+def build_summary_prompt(previous_summary: str, turns: List[Turn], max_words: int = 150) -> str:
+    dialogue = "\n".join(turn.line() for turn in turns)
+    prompt = "Ты ведёшь краткий пересказ ролевой игры.\n\n"
+    if previous_summary:
+        prompt += f"Пересказ предыдущих событий:\n{previous_summary.strip()}\n\n"
+    prompt += (
+        f"Новые события:\n{dialogue}\n\n"
+        f"Напиши обновлённый пересказ всех событий: кто участвует, что произошло, важные факты, предметы и обещания. "
+        f"Не больше {max_words} слов, от третьего лица, без диалогов. Ответь только пересказом."
+    )
+    return prompt
+
+
+
+# Adding the summary of earlier events to the system prompt
+def add_summary_to_prompt(system_prompt: str, summary: dict) -> str:
+    if not summary or not summary.get("text"):
+        return system_prompt
+    return f"{system_prompt}\n\nКраткое содержание предыдущих событий:\n{summary['text']}"
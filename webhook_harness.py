@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# webhook_harness.py
+# This file is part of the BotAnya Telegram Bot project.
+# Local harness for the webhook mode: posts synthetic Telegram updates to a running bot.
+#
+# Usage:
+#   python webhook_harness.py --text "Привет!" --user 123456 --count 5
+#   python webhook_harness.py --text "/whoami" --url http://127.0.0.1:8443/telegram
+#
+# The bot answers to the given chat id through the real Bot API,
+# so use your own Telegram id to see the replies.
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import httpx
+from config import CONFIG_FILE, CREDENTIALS_FILE
+
+
+
+# Default webhook url from config.json
+def _default_url() -> str:
+    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+        webhook = json.load(f).get("runtime", {}).get("webhook", {})
+    port = webhook.get("port", 8443)
+    url_path = webhook.get("url_path", "").strip("/")
+    return f"http://127.0.0.1:{port}/{url_path}"
+
+
+
+# Secret token from credentials.json
+def _secret_token() -> str:
+    if not os.path.exists(CREDENTIALS_FILE):
+        return ""
+    with open(CREDENTIALS_FILE, "r", encoding="utf-8") as f:
+        return json.load(f).get("webhook_secret_token", "")
+
+
+
+# Building a synthetic text message update
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": "Harness"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Harness", "username": "harness"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+
+async def post_updates(url: str, user_id: int, text: str, count: int, secret: str):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    base_id = int(time.time() * 1000) % 1_000_000_000
+
+    async with httpx.AsyncClient(timeout=10) as client:
+        for i in range(count):
+            update = make_update(base_id + i, user_id, text)
+            started = time.perf_counter()
+            response = await client.post(url, json=update, headers=headers)
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"#{i + 1} update_id={update['update_id']} → HTTP {response.status_code} ({elapsed:.1f} ms)")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Posts synthetic updates to the BotAnya webhook.")
+    parser.add_argument("--url", default=None, help="Webhook url (default: from config.json)")
+    parser.add_argument("--user", type=int, default=1, help="Telegram user/chat id")
+    parser.add_argument("--text", default="/start", help="Message text or command")
+    parser.add_argument("--count", type=int, default=1, help="Number of updates to send")
+    parser.add_argument("--secret", default=None, help="Secret token (default: from credentials.json)")
+    args = parser.parse_args()
+
+    asyncio.run(post_updates(
+        args.url or _default_url(),
+        args.user,
+        args.text,
+        args.count,
+        args.secret if args.secret is not None else _secret_token(),
+    ))
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2025 NDRco
+# Licensed under the MIT License. See LICENSE file in the project root for full license information.
+
+# worker_pool.py
+# This file is part of the BotAnya Telegram Bot project.
+# Supervisor mode: one process receives updates and routes them to worker processes by user id.
+# Each worker handles the updates of its users in order, keeps their state and its own service
+# connections, so the CPU work of the handlers is spread over several cores.
+
+import asyncio
+import contextlib
+import multiprocessing
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import HTTPXRequest
+from bot_state import bot_state, init_config, init_state_backend, load_roles, save_roles, load_history, save_history
+from telegram_handlers import get_bot_commands
+from typing_ticker import typing_ticker
+from loop_monitor import loop_monitor
+from tokenizers_registry import warm_up_tokenizers
+from config_reload import reload_config, reload_listeners
+from config import CONNECT_TIMEOUT, READ_TIMEOUT, WORKER_RESTART_DELAY, WORKER_SAVE_TIMEOUT
+
+
+
+# Worker of the user: Telegram ids are integers, so the route does not change between restarts
+def worker_for(user_id: int, workers: int) -> int:
+    return user_id % workers
+
+
+
+# Entry point of a worker process (spawned: it starts with freshly imported modules)
+def run_worker(index: int, workers: int, conn):
+    # Ctrl+C, SIGTERM and SIGHUP reach the whole process group: the supervisor stops and reloads workers itself
+    for name in ("SIGINT", "SIGTERM", "SIGHUP"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+    asyncio.run(_worker_main(index, workers, conn))
+
+
+
+async def _worker_main(index: int, workers: int, conn):
+    # imported here: BotAnya imports this module in main()
+    from BotAnya import build_application, get_drain_timeout, drain_application
+
+    init_config()
+    bot_state.workers = workers
+    warm_up_tokenizers(list(bot_state.config.get("services", {}).values()))
+    init_state_backend()
+    load_roles()
+    load_history()
+
+    app = build_application(updater=False, workers=workers)
+    await app.initialize()
+    await app.start()
+    typing_ticker.start(app.bot)
+    loop_monitor.start()
+    # /reload in this worker reloads the others through the supervisor
+    reload_listeners.append(lambda: conn.send({"reload": True}))
+    print(f"⚙️ Процесс-обработчик {index} запущен")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                message = await loop.run_in_executor(None, conn.recv)
+            except (EOFError, OSError):
+                print(f"⚠️ Процесс-обработчик {index}: связь с супервизором потеряна.")
+                break
+            if message is None:
+                break
+            if message.get("reload"):
+                reload_config()
+            else:
+                await app.update_queue.put(Update.de_json(message["update"], app.bot))
+    finally:
+        # Draining: updates that are already being processed are finished
+        drain_timeout = get_drain_timeout(bot_state.config.get("runtime", {}))
+        if not await drain_application(app, drain_timeout):
+            print(f"⚠️ Процесс-обработчик {index}: запросы не завершились за {drain_timeout} с.")
+        await typing_ticker.stop()
+        await loop_monitor.stop()
+        await app.shutdown()
+        save_history()
+        save_roles()
+        bot_state.backend.close()
+        conn.close()
+        print(f"✅ Процесс-обработчик {index}: история и роли сохранены.")
+
+
+
+class WorkerPool:
+    """
+    Worker processes of the supervisor. Updates of a worker go through its own queue and pipe
+    in the order they arrived; each pipe has its own sending task, so a busy worker does not
+    hold up the others. A worker that exited is started again after WORKER_RESTART_DELAY,
+    updates queued for it wait for the new process.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._conns = [None] * workers
+        self._queues = []
+        # blocking pipe calls: one sender and one receiver per worker
+        self._pipe_pool = ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix="worker-pipe")
+        self._tasks = set()
+        self._stopping = False
+
+
+    def start(self):
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        for index in range(self.workers):
+            self._spawn(index)
+            self._add_task(self._send(index))
+        self._add_task(self._watch())
+
+
+    def _add_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+    def _spawn(self, index: int):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=run_worker, args=(index, self.workers, child_conn),
+                                        name=f"BotAnya-worker-{index}")
+        process.start()
+        child_conn.close()
+        self._processes[index] = process
+        self._conns[index] = conn
+        self._add_task(self._receive(index, conn))
+
+
+    # Routing an update to the worker of its user (updates without a user go to the first worker)
+    def route(self, update: Update):
+        sender = update.effective_user or update.effective_chat
+        index = worker_for(sender.id if sender else 0, self.workers)
+        self._queues[index].put_nowait({"update": update.to_dict()})
+
+
+    def broadcast(self, message, skip: int = None):
+        for index, queue in enumerate(self._queues):
+            if index != skip:
+                queue.put_nowait(message)
+
+
+    # Reloading the config here and in the workers (skip = the worker that already reloaded it)
+    def reload(self, skip: int = None):
+        if not reload_config():
+            self.broadcast({"reload": True}, skip)
+
+
+    async def _send(self, index: int):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[index]
+        while True:
+            message = await queue.get()
+            while True:
+                try:
+                    await loop.run_in_executor(self._pipe_pool, self._conns[index].send, message)
+                    break
+                except OSError:
+                    if self._stopping:
+                        return
+                    # the worker exited: _watch() starts a new one
+                    await asyncio.sleep(WORKER_RESTART_DELAY)
+            if message is None:
+                return
+
+
+    async def _receive(self, index: int, conn):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                message = await loop.run_in_executor(self._pipe_pool, conn.recv)
+            except (EOFError, OSError):
+                return
+            if message.get("reload"):
+                self.reload(skip=index)
+
+
+    async def _watch(self):
+        while not self._stopping:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for index, process in enumerate(self._processes):
+                if self._stopping or process.is_alive():
+                    continue
+                print(f"⚠️ Процесс-обработчик {index} завершился (код {process.exitcode}), перезапускаю.")
+                self._conns[index].close()
+                self._spawn(index)
+
+
+    # Stopping the workers: they finish their updates and save the state, then are killed after timeout
+    async def stop(self, timeout: float):
+        self._stopping = True
+        self.broadcast(None)
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self._processes):
+            await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                print(f"⚠️ Процесс-обработчик {index} не завершился за {timeout} с, останавливаю принудительно.")
+                process.kill()
+                await loop.run_in_executor(None, process.join)
+
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for conn in self._conns:
+            conn.close()
+        self._pipe_pool.shutdown(wait=False)
+
+
+
+# Supervisor: receives updates (polling or webhook) and passes them to the worker processes
+async def run_supervisor(workers: int):
+    # imported here: BotAnya imports this module in main()
+    from BotAnya import start_webhook, get_drain_timeout
+
+    # the database is created (and the files are imported) once, before the workers open it
+    init_state_backend()
+    bot_state.backend.close()
+
+    pool = WorkerPool(workers)
+    pool.start()
+
+    # Only routing here, so updates keep the order they arrived in
+    async def route_update(update: Update, context):
+        pool.route(update)
+
+    request = HTTPXRequest(
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT
+    )
+    app = ApplicationBuilder().token(bot_state.bot_token).request(request).build()
+    app.add_handler(TypeHandler(Update, route_update))
+    await app.initialize()
+    await app.bot.set_my_commands(get_bot_commands())
+    await app.start()
+
+    # Stop on SIGTERM/SIGINT, reload config.json in all processes on SIGHUP
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    if hasattr(signal, "SIGHUP"):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signal.SIGHUP, pool.reload)
+
+    runtime = bot_state.config.get("runtime", {})
+    webhook_config = runtime.get("webhook", {})
+    polling_task = None
+    if runtime.get("mode", "polling") == "webhook":
+        await start_webhook(app, webhook_config)
+    else:
+        polling_task = asyncio.create_task(app.updater.start_polling())
+    print(f"Бот запущен: {workers} процессов-обработчиков 🚀")
+
+    try:
+        await stop_event.wait()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if polling_task:
+            polling_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await polling_task
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+        print("⏳ Жду завершения процессов-обработчиков...")
+        await pool.stop(get_drain_timeout(runtime) + WORKER_SAVE_TIMEOUT)
+        print("🔚 Завершение работы.")